@@ -0,0 +1,677 @@
+"""
+性能基准测试脚本
+
+用法：
+    python benchmark.py aggregate --records 1000000
+    python benchmark.py memory --records 800000
+    python benchmark.py rules --messages 20000
+    python benchmark.py backfill --days 56
+    python benchmark.py fetch --days 14 --latency 3
+    python benchmark.py pipeline --records-per-day 100000
+    python benchmark.py daemon --latency 3
+    python benchmark.py serve --port 8080
+
+所有基准测试都使用合成数据，不需要 cookie 或真实的 Dynatrace 租户；
+查询相关的测试使用本地的 Dynatrace 替身服务器（MockDynatraceServer）。
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import fetch_dynatrace_records as fdr
+
+# 合成数据使用的应用名和异常消息模板
+SYNTHETIC_APPS = [f"central-service-{i}" for i in range(20)]
+SYNTHETIC_MESSAGES = [
+    "Call entry with interaction_id='{id}' not found",
+    "Unable to redirect call CA{id}: 400 - [400] Bad Request",
+    "Account '{id}' has no UC Configs",
+    "Errno::ECONNRESET: Connection reset by peer (for 10.0.{n}.1:27017)",
+    "Could not select a phone to call +91{n}",
+    "NoMethodError {n}",
+]
+
+
+def generate_records(count, distinct_messages=5000, seed=0):
+    """
+    生成与 query.txt 输出结构一致的合成记录
+
+    Args:
+        count: 记录数量
+        distinct_messages: 不同异常消息的数量
+        seed: 随机种子，保证多次运行结果一致
+
+    Returns:
+        list: 记录列表
+    """
+    rng = random.Random(seed)
+    messages = [
+        SYNTHETIC_MESSAGES[i % len(SYNTHETIC_MESSAGES)].format(id=f"{i:024x}", n=i)
+        for i in range(distinct_messages)
+    ]
+    stacktraces = [f"app/models/model_{i}.rb:{i * 7}:in `call'" for i in range(distinct_messages // 10 or 1)]
+    records = []
+    for _ in range(count):
+        # 与真实数据一样，每条消息只来自少数几个应用、只对应少数几种堆栈
+        index = rng.randrange(distinct_messages)
+        records.append({
+            "app": SYNTHETIC_APPS[(index + rng.randint(0, 1)) % len(SYNTHETIC_APPS)],
+            "span.events.exception.message": messages[index],
+            "span.events.exception.stack_trace": stacktraces[(index + rng.randint(0, 2)) % len(stacktraces)],
+            "count()": str(rng.randint(1, 50)),
+            "min(start_time)": "2025-10-14T02:00:00.000000000Z",
+        })
+    return records
+
+
+def bench_aggregate(args):
+    """对 aggregate_datasets 在不同数据量下计时，验证耗时随记录数线性增长。"""
+    sizes = [args.records // 8, args.records // 4, args.records // 2, args.records]
+    print(f"{'records':>10} {'seconds':>10} {'ns/record':>10}")
+    for size in sizes:
+        # 按 handle_data 的方式拆分成当前/上一个工作日两个7天数据集和两个1天数据集
+        half = size // 2
+        records = generate_records(size, distinct_messages=args.distinct, seed=size)
+        current_7_days, previous_7_days = records[:half], records[half:]
+        current_1_day, previous_1_day = current_7_days[-half // 7:], previous_7_days[-half // 7:]
+
+        start = time.perf_counter()
+        fdr.aggregate_datasets([
+            (current_7_days, "current_7_days_count", True),
+            (previous_7_days, "previous_workday_7_days_count", True),
+            (current_1_day, "last_1_day_count", False),
+            (previous_1_day, "pre_last_1_day_count", False),
+        ])
+        elapsed = time.perf_counter() - start
+        print(f"{size:>10} {elapsed:>10.3f} {elapsed / size * 1e9:>10.0f}")
+
+
+def write_dataset(output_dir, records_per_day, distinct_messages, seed):
+    """在 output_dir 下生成 7 个 dql_result_for_day_{n}.json，逐天生成以免基准测试本身占用大量内存。"""
+    os.makedirs(output_dir, exist_ok=True)
+    for day in range(1, 8):
+        records = generate_records(records_per_day, distinct_messages=distinct_messages, seed=seed + day)
+        with open(f"{output_dir}/dql_result_for_day_{day}.json", 'w') as f:
+            json.dump(records, f, indent=4)
+
+
+def peak_rss_child(args):
+    """子进程入口：按指定方式聚合数据集，输出峰值常驻内存（MB）。"""
+    current_dir, previous_dir = f"{args.data_dir}/current", f"{args.data_dir}/previous"
+    if args.mode == "stream":
+        fdr.aggregate_output_dirs(current_dir, previous_dir)
+    else:
+        # 旧的做法：把两个7天数据集全部加载到列表中再聚合
+        datasets = []
+        for output_dir, field in ((current_dir, "current_7_days_count"), (previous_dir, "previous_workday_7_days_count")):
+            records = []
+            for day in range(1, 8):
+                with open(f"{output_dir}/dql_result_for_day_{day}.json", 'r') as f:
+                    records.extend(json.load(f))
+            datasets.append((records, field, True))
+        fdr.aggregate_datasets(datasets)
+    # Linux 下 ru_maxrss 的单位是 KB
+    print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+
+def bench_memory(args):
+    """在不同数据量下比较流式聚合和整体加载的峰值常驻内存，流式聚合的峰值应基本不随记录数增长。"""
+    sizes = [args.records // 4, args.records // 2, args.records]
+    print(f"{'records':>10} {'file MB':>10} {'load MB':>10} {'stream MB':>10}")
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as data_dir:
+            records_per_day = size // 14
+            write_dataset(f"{data_dir}/current", records_per_day, args.distinct, seed=0)
+            write_dataset(f"{data_dir}/previous", records_per_day, args.distinct, seed=100)
+            file_mb = sum(
+                os.path.getsize(os.path.join(root, name))
+                for root, _, names in os.walk(data_dir) for name in names
+            ) / 1024 ** 2
+
+            peaks = {}
+            for mode in ("load", "stream"):
+                output = subprocess.run(
+                    [sys.executable, __file__, "memory-child", "--data-dir", data_dir, "--mode", mode],
+                    check=True, capture_output=True, text=True,
+                ).stdout
+                peaks[mode] = float(output.strip().splitlines()[-1])
+        print(f"{size:>10} {file_mb:>10.0f} {peaks['load']:>10.0f} {peaks['stream']:>10.0f}")
+
+
+ERRNO_NAMES = ["ECONNRESET", "ECONNREFUSED", "ETIMEDOUT", "EHOSTUNREACH", "ENETUNREACH", "EPIPE", "ENOTCONN", "EADDRNOTAVAIL"]
+SSL_REASONS = ["certificate verify failed", "wrong version number", "unexpected eof while reading",
+               "tlsv1 alert protocol version", "sslv3 alert handshake failure"]
+
+
+def generate_rules(count):
+    """
+    在 FUZZY_RULES 的基础上补充合成规则，直到规则数达到 count
+
+    与真实规则表一样，大部分新规则属于少数几个异常类族（Errno::*、OpenSSL::SSL::SSLError），
+    字面量前缀的前 FUZZY_RULE_PREFIX_LENGTH 个字符相同，落在同一个索引桶中。
+    """
+    rules = list(fdr.FUZZY_RULES)
+    words = ["Timeout", "Redis", "Kafka", "Twilio", "Mongo", "Sidekiq", "Webhook", "Queue", "Token", "Socket"]
+    i = 0
+    while len(rules) < count:
+        family = i % 5
+        if family in (0, 1):
+            rules.append(f"Errno::{ERRNO_NAMES[i % len(ERRNO_NAMES)]}: .* \\(for .*:{27000 + i}( .*)?\\)")
+        elif family in (2, 3):
+            rules.append(f"OpenSSL::SSL::SSLError: SSL_connect returned=1 errno=0 peeraddr=.*:{8000 + i} "
+                         f"state=error: {SSL_REASONS[i % len(SSL_REASONS)]}")
+        else:
+            rules.append(f"{words[i % len(words)]}{i}::Error: failed to process .* after \\d+ attempts")
+        i += 1
+    return rules
+
+
+def generate_rule_messages(count, seed=0):
+    """生成落在 Errno::*、OpenSSL::* 索引桶中的消息，端口随机，只有一部分能被合成规则匹配。"""
+    rng = random.Random(seed)
+    messages = []
+    for i in range(count):
+        port = rng.randrange(8000, 8800) if i % 2 else rng.randrange(27000, 27800)
+        if i % 2:
+            messages.append(f"OpenSSL::SSL::SSLError: SSL_connect returned=1 errno=0 peeraddr=10.1.{i % 250}.7:{port} "
+                            f"state=error: {SSL_REASONS[rng.randrange(len(SSL_REASONS))]}")
+        else:
+            messages.append(f"Errno::{ERRNO_NAMES[rng.randrange(len(ERRNO_NAMES))]}: Connection failed {i} "
+                            f"(for 10.0.{i % 250}.1:{port})")
+    return messages
+
+
+def bench_rules(args):
+    """
+    比较逐条 fullmatch 和 FuzzyRuleEngine 在规则数增长时的分类耗时
+
+    一半消息来自 generate_records，另一半落在 Errno::*、OpenSSL::* 这类大索引桶中。
+    同时输出最大的索引桶和每条消息平均要检查的候选规则数、实际执行的正则匹配数，
+    说明前缀索引在同族规则很多时的效果。
+    """
+    messages = [record["span.events.exception.message"]
+                for record in generate_records(args.messages // 2, distinct_messages=args.messages // 2)]
+    messages += generate_rule_messages(args.messages - len(messages))
+    length = fdr.FUZZY_RULE_PREFIX_LENGTH
+    print(f"{'rules':>8} {'naive s':>10} {'engine s':>10} {'cached s':>10} "
+          f"{'max bucket':>16} {'candidates/msg':>15} {'regex/msg':>10}")
+    for rule_count in (25, 100, 400, 800):
+        rules = generate_rules(rule_count)
+
+        # 逐条匹配的规则同样预编译，超过 re 模块 512 条的编译缓存后不会每次重新编译，只比较索引本身的效果
+        patterns = [re.compile(rule, flags=re.DOTALL) for rule in rules]
+        start = time.perf_counter()
+        for message in messages:
+            for pattern in patterns:
+                if pattern.fullmatch(message.strip()):
+                    break
+        naive = time.perf_counter() - start
+
+        # 不带缓存，衡量索引本身的效果
+        engine = fdr.FuzzyRuleEngine(rules, cache_size=0)
+        start = time.perf_counter()
+        for message in messages:
+            engine.classify(message)
+        indexed = time.perf_counter() - start
+
+        # 每条消息要检查前缀的候选规则数，和通过前缀检查、实际执行正则的规则数（匹配成功即停止）
+        buckets = {}
+        unindexed = 0
+        for prefix in engine.prefixes:
+            if len(prefix) >= length:
+                buckets[prefix[:length]] = buckets.get(prefix[:length], 0) + 1
+            else:
+                unindexed += 1
+        candidates = regex_calls = 0
+        for message in messages:
+            text = message.strip()
+            candidates += buckets.get(text[:length], 0) + unindexed
+            for rule, pattern, prefix in zip(engine.rules, engine.patterns, engine.prefixes):
+                if text.startswith(prefix):
+                    regex_calls += 1
+                    if pattern.fullmatch(text):
+                        break
+        largest = max(buckets, key=buckets.get)
+
+        # 带缓存，第二遍全部命中 LRU 缓存
+        engine = fdr.FuzzyRuleEngine(rules)
+        for message in messages:
+            engine.classify(message)
+        start = time.perf_counter()
+        for message in messages:
+            engine.classify(message)
+        cached = time.perf_counter() - start
+        print(f"{rule_count:>8} {naive:>10.3f} {indexed:>10.3f} {cached:>10.3f} "
+              f"{repr(largest) + ': ' + str(buckets[largest]):>16} {candidates / len(messages):>15.1f} "
+              f"{regex_calls / len(messages):>10.1f}")
+
+
+def bench_backfill(args):
+    """回填模式下不同进程数的聚合耗时，耗时应随进程数（不超过 CPU 核心数）近似成比例下降。"""
+    start_date = datetime(2025, 1, 1)
+    with tempfile.TemporaryDirectory() as data_dir:
+        day_files = []
+        for i in range(args.days):
+            date_obj = start_date + timedelta(days=i)
+            filename = fdr.day_filename(data_dir, date_obj.strftime("%Y%m%d"))
+            fdr.write_day_records(generate_records(args.records_per_day, distinct_messages=args.distinct, seed=i),
+                                  filename)
+            day_files.append((fdr.DEFAULT_ENVIRONMENT, date_obj.strftime("%Y-%m-%d"), filename))
+
+        worker_counts = sorted({1, 2, 4, os.cpu_count() or 1})
+        print(f"{'workers':>8} {'seconds':>10} {'speedup':>10}")
+        baseline = None
+        for workers in worker_counts:
+            start = time.perf_counter()
+            fdr.aggregate_backfill(day_files, start_date, max_workers=workers)
+            elapsed = time.perf_counter() - start
+            baseline = baseline or elapsed
+            print(f"{workers:>8} {elapsed:>10.3f} {baseline / elapsed:>10.2f}")
+
+
+class MockDynatraceServer(ThreadingHTTPServer):
+    """
+    本地的 Dynatrace DQL 替身服务器，实现 query:execute 和 query:poll 两个接口
+
+    每个查询先排队 queued 秒（状态 NOT_STARTED），再运行约 latency 秒（状态 RUNNING，实际耗时在 0.5~1.5 倍之间随机），
+    之后返回与 query.txt 输出结构一致的合成记录，记录数按窗口时长从 records_per_day 折算。
+    poll 支持长轮询：在 request-timeout-milliseconds 内查询完成就立即返回结果。
+
+    Args:
+        http_error_rate: execute 和 poll 返回 503 的概率，用于测试重试
+        query_failure_rate: 查询最终状态为 FAILED 的概率
+        max_records: 单次查询最多返回的记录数，超出时截断并返回截断通知，为 None 时不限制
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=2.0, queued=0.0, records_per_day=20000, distinct_messages=2000,
+                 http_error_rate=0.0, query_failure_rate=0.0, max_records=None, seed=0):
+        super().__init__(("127.0.0.1", port), MockDynatraceHandler)
+        self.latency = latency
+        self.queued = queued
+        self.records_per_day = records_per_day
+        self.distinct_messages = distinct_messages
+        self.http_error_rate = http_error_rate
+        self.query_failure_rate = query_failure_rate
+        self.max_records = max_records
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.queries = {}
+        self.stats = {"execute": 0, "poll": 0, "http_errors": 0, "failed": 0, "truncated": 0}
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        """在后台线程中运行，返回 self 以便链式调用。"""
+        threading.Thread(target=self.serve_forever, name="mock-dynatrace", daemon=True).start()
+        return self
+
+    def random(self):
+        with self.lock:
+            return self.rng.random()
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def submit(self, body):
+        """登记一个查询，返回 requestToken。"""
+        now = time.monotonic()
+        started_at = now + self.queued
+        token = uuid.uuid4().hex
+        with self.lock:
+            self.queries[token] = {
+                "body": body,
+                "started_at": started_at,
+                "finished_at": started_at + self.latency * self.rng.uniform(0.5, 1.5),
+                "failed": self.rng.random() < self.query_failure_rate,
+            }
+        return token
+
+    def result(self, body):
+        """生成一个查询窗口的结果，相同窗口每次生成的记录相同。"""
+        start = datetime.fromisoformat(body["defaultTimeframeStart"])
+        end = datetime.fromisoformat(body["defaultTimeframeEnd"])
+        count = max(1, int(self.records_per_day * (end - start).total_seconds() / 86400))
+        seed = int(hashlib.md5(body["defaultTimeframeStart"].encode()).hexdigest()[:8], 16)
+        records = generate_records(count, distinct_messages=self.distinct_messages, seed=seed)
+        for record in records:
+            record["min(start_time)"] = start.strftime("%Y-%m-%dT%H:%M:%S.000000000Z")
+        records = project_records(records, body["query"])
+
+        notifications = []
+        if self.max_records is not None and len(records) > self.max_records:
+            records = records[:self.max_records]
+            notifications.append({"notificationType": "RESULT_TRUNCATED", "message": "Result has been truncated."})
+            self.count("truncated")
+        return {
+            "records": records,
+            "metadata": {"grail": {
+                "executionTimeMilliseconds": int(self.latency * 1000),
+                "scannedBytes": count * 4096,
+                "notifications": notifications,
+            }},
+        }
+
+
+def project_records(records, query):
+    """
+    按两阶段查询的消息过滤条件筛选记录，再按最后一个 summarize 的分组字段投影并合并，
+    使两阶段查询也能得到相应结构的结果。
+    """
+    prefix = "| filter in(span.events.exception.message, array("
+    for line in query.splitlines():
+        if line.startswith(prefix) and line.endswith("))"):
+            messages = set(json.loads("[" + line[len(prefix):-2] + "]"))
+            records = [record for record in records if record.get("span.events.exception.message") in messages]
+    summarize = query[query.rfind("| summarize"):] if "| summarize" in query else ""
+    match = re.search(r"by:\s*\{([^}]*)\}", summarize)
+    if not match:
+        return records
+    fields = [field.strip() for field in match.group(1).split(",")]
+    if "span.events.exception.stack_trace" in fields:
+        return records
+    projected = [
+        {name: value for name, value in record.items() if name in fields or name == "count()"}
+        for record in records
+    ]
+    return fdr.merge_partial_records([projected])
+
+
+class MockDynatraceHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def maybe_fail(self):
+        if self.server.random() < self.server.http_error_rate:
+            self.server.count("http_errors")
+            self.send_json(503, {"error": {"code": 503, "message": "Service Unavailable"}})
+            return True
+        return False
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if urlparse(self.path).path != fdr.DQL_EXECUTE_PATH:
+            self.send_json(404, {"error": {"code": 404, "message": "Not Found"}})
+            return
+        self.server.count("execute")
+        if self.maybe_fail():
+            return
+        token = self.server.submit(body)
+        self.send_json(202, {"state": "NOT_STARTED" if self.server.queued else "RUNNING", "requestToken": token})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != fdr.DQL_POLL_PATH:
+            self.send_json(404, {"error": {"code": 404, "message": "Not Found"}})
+            return
+        self.server.count("poll")
+        if self.maybe_fail():
+            return
+        params = parse_qs(url.query)
+        query = self.server.queries.get(params.get("request-token", [""])[0])
+        if query is None:
+            self.send_json(200, {"state": "RESULT_GONE"})
+            return
+
+        # 长轮询：在超时之前查询完成就立即返回
+        timeout = int(params.get("request-timeout-milliseconds", ["0"])[0]) / 1000
+        time.sleep(max(0.0, min(query["finished_at"] - time.monotonic(), timeout)))
+        now = time.monotonic()
+        if now < query["started_at"]:
+            self.send_json(200, {"state": "NOT_STARTED"})
+        elif now < query["finished_at"]:
+            self.send_json(200, {"state": "RUNNING", "progress": int(
+                100 * (now - query["started_at"]) / (query["finished_at"] - query["started_at"]))})
+        elif query["failed"]:
+            self.server.count("failed")
+            self.send_json(200, {"state": "FAILED", "error": {"message": "Query failed"}})
+        else:
+            self.send_json(200, {"state": "SUCCEEDED", "progress": 100, "result": self.server.result(query["body"])})
+
+
+def mock_server_from_args(args, port=0):
+    return MockDynatraceServer(
+        port=port, latency=args.latency, queued=args.queued, records_per_day=args.records_per_day,
+        distinct_messages=args.distinct, http_error_rate=args.http_error_rate,
+        query_failure_rate=args.query_failure_rate, max_records=args.max_records,
+    )
+
+
+def bench_fetch(args):
+    """在本地替身服务器上比较 1、2、4、8 个并发查询获取 days 天数据的耗时和轮询次数。"""
+    with open("resources/query.txt", 'r', encoding='utf-8') as f:
+        query = f.read()
+    server = mock_server_from_args(args).start()
+    start_date = datetime(2025, 1, 1)
+    windows = []
+    for i in range(args.days):
+        date_obj = start_date + timedelta(days=i)
+        windows.append((date_obj.strftime("%Y-%m-%d"), *fdr.day_window(date_obj)))
+
+    print(f"{'workers':>8} {'seconds':>10} {'polls':>8} {'retries':>8} {'failed':>8}")
+    for workers in (1, 2, 4, 8):
+        # 每轮使用新的查询槽位和指标，并发数由 workers 决定
+        fdr.query_slots = threading.BoundedSemaphore(workers)
+        fdr.run_metrics.reset()
+        with tempfile.TemporaryDirectory() as output_dir, \
+                fdr.DynatraceClient("cookie", "csrftoken", base_url=server.base_url, pool_size=workers) as client:
+            start = time.perf_counter()
+            slice_plan = fdr.SlicePlan(f"{output_dir}/slice_plan.json") if args.adaptive else None
+            results = fdr.fetch_windows(client, query, windows, output_dir, max_workers=workers,
+                                        slice_plan=slice_plan)
+            elapsed = time.perf_counter() - start
+        counters = fdr.run_metrics.counters
+        failed = sum(1 for filename in results.values() if filename is None)
+        print(f"{workers:>8} {elapsed:>10.2f} {counters.get('dql.polls', 0):>8} "
+              f"{counters.get('http.execute_retries', 0):>8} {failed:>8}")
+    server.shutdown()
+    print(f"服务器统计：{server.stats}")
+
+
+def bench_pipeline(args):
+    """
+    handle_data 的负载生成器：生成今天和上一个工作日两个7天数据集，对聚合、分类和报表写出计时
+
+    在临时目录中运行，快照和窗口状态等缓存不会影响当前目录；第二轮复用第一轮的快照，对应日常运行的增量聚合。
+    """
+    with tempfile.TemporaryDirectory() as work_dir:
+        previous_cwd = os.getcwd()
+        os.chdir(work_dir)
+        try:
+            start_date = datetime(2025, 1, 1)
+            # 两个数据集错开一天，与日常运行一样共享 6 天
+            for output_dir, offset in (("current", 1), ("previous", 0)):
+                os.makedirs(output_dir, exist_ok=True)
+                for day in range(1, 8):
+                    seed = (start_date + timedelta(days=offset + day)).toordinal()
+                    records = generate_records(args.records_per_day, distinct_messages=args.distinct, seed=seed)
+                    fdr.write_day_records(records, fdr.day_filename(output_dir, day))
+            context = fdr.RunContext()
+            context.output_dir, context.previous_workday_output_dir = "current", "previous"
+
+            print(f"{'run':>6} {'aggregate s':>12} {'categorize s':>13} {'report s':>10} {'total s':>10}")
+            for run in ("cold", "warm"):
+                fdr.run_metrics.reset()
+                start = time.perf_counter()
+                fdr.handle_data(context)
+                elapsed = time.perf_counter() - start
+                stages = fdr.run_metrics.stages
+                print(f"{run:>6} {stages['aggregate']['seconds']:>12.3f} {stages['categorize']['seconds']:>13.3f} "
+                      f"{stages['report']['seconds']:>10.3f} {elapsed:>10.3f}")
+        finally:
+            os.chdir(previous_cwd)
+
+
+def bench_daemon(args):
+    """
+    常驻模式与单次运行生成例会报表的耗时对比
+
+    常驻模式从前一天 10:05 开始每小时运行一次 tick（预热，不计时），例会当天 10:05 窗口结束后只需获取最后一个时间片；
+    单次运行在同一时间从空缓存开始获取全部日期。常驻模式的 fetch s 包括获取最后一个时间片和重新计算汇总。
+    在临时目录中运行，不影响当前目录的缓存和输出。
+    """
+    with open("resources/query.txt", 'r', encoding='utf-8') as f:
+        query = f.read()
+    server = mock_server_from_args(args).start()
+    meeting = datetime(2025, 1, 8, 10, 5)
+    previous_base_url = fdr.DYNATRACE_BASE_URL
+    previous_cwd = os.getcwd()
+    fdr.DYNATRACE_BASE_URL = server.base_url
+
+    print(f"{'mode':>10} {'fetch s':>10} {'report s':>10} {'total s':>10} {'queries':>8} {'warm-up queries':>16}")
+    try:
+        for mode in ("one-shot", "daemon"):
+            with tempfile.TemporaryDirectory() as work_dir:
+                prepare_work_dir(work_dir, query)
+                os.chdir(work_dir)
+                fdr.run_metrics.reset()
+                warm_queries = "-"
+                if mode == "one-shot":
+                    executed = server.stats["execute"]
+                    start = time.perf_counter()
+                    fdr.main(fdr.RunContext(meeting))
+                    fetched = start + fdr.run_metrics.stages["fetch"]["seconds"]
+                else:
+                    daemon = fdr.ReportDaemon()
+                    executed = server.stats["execute"]
+                    for hours in range(24, 0, -1):
+                        daemon.tick(meeting - timedelta(hours=hours))
+                    warm_queries = server.stats["execute"] - executed
+                    executed = server.stats["execute"]
+                    start = time.perf_counter()
+                    daemon.tick(meeting)
+                    fetched = time.perf_counter()
+                    daemon.render(["xlsx"])
+                finished = time.perf_counter()
+                print(f"{mode:>10} {fetched - start:>10.3f} {finished - fetched:>10.3f} {finished - start:>10.3f} "
+                      f"{server.stats['execute'] - executed:>8} {warm_queries:>16}")
+                os.chdir(previous_cwd)
+    finally:
+        os.chdir(previous_cwd)
+        fdr.DYNATRACE_BASE_URL = previous_base_url
+        server.shutdown()
+
+
+def prepare_work_dir(work_dir, query):
+    """在临时目录中准备 resources/（查询语句和占位的 cookie、csrftoken），主脚本在其中运行时不影响当前目录的缓存和输出。"""
+    os.makedirs(f"{work_dir}/resources", exist_ok=True)
+    for name, content in (("query.txt", query), ("cookie.txt", "cookie"), ("csrftoken.txt", "csrftoken")):
+        with open(f"{work_dir}/resources/{name}", 'w', encoding='utf-8') as f:
+            f.write(content)
+
+
+def serve(args):
+    """
+    单独运行替身服务器，设置环境变量 DYNATRACE_BASE_URL 后可以让主脚本连接它
+
+    同时准备一个临时工作目录，提示在其中运行主脚本，替身的数据不会写入当前目录的 cache/ 和 output/。
+    """
+    with open("resources/query.txt", 'r', encoding='utf-8') as f:
+        query = f.read()
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="dynatrace-mock-")
+    prepare_work_dir(work_dir, query)
+    server = mock_server_from_args(args, port=args.port)
+    print(f"Dynatrace 替身服务器已启动：{server.base_url}")
+    print(f"运行：cd {work_dir} && DYNATRACE_BASE_URL={server.base_url} "
+          f"python {os.path.abspath(fdr.__file__)}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"服务器统计：{server.stats}")
+
+
+def add_mock_server_arguments(parser):
+    parser.add_argument("--latency", type=float, default=2.0, help="每个查询的平均运行秒数")
+    parser.add_argument("--queued", type=float, default=0.0, help="每个查询开始运行前的排队秒数")
+    parser.add_argument("--records-per-day", type=int, default=20000, help="每天窗口返回的记录数")
+    parser.add_argument("--distinct", type=int, default=2000, help="不同异常消息的数量")
+    parser.add_argument("--http-error-rate", type=float, default=0.0, help="接口返回 503 的概率")
+    parser.add_argument("--query-failure-rate", type=float, default=0.0, help="查询状态为 FAILED 的概率")
+    parser.add_argument("--max-records", type=int, default=None, help="单次查询最多返回的记录数，超出时截断")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="fetch_dynatrace_records 性能基准测试")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    aggregate_parser = subparsers.add_parser("aggregate", help="聚合引擎的线性扩展测试")
+    aggregate_parser.add_argument("--records", type=int, default=1_000_000, help="最大记录数")
+    aggregate_parser.add_argument("--distinct", type=int, default=5000, help="不同异常消息的数量")
+    aggregate_parser.set_defaults(func=bench_aggregate)
+
+    memory_parser = subparsers.add_parser("memory", help="流式聚合的峰值内存测试")
+    memory_parser.add_argument("--records", type=int, default=800_000, help="两个7天数据集的最大总记录数")
+    memory_parser.add_argument("--distinct", type=int, default=5000, help="不同异常消息的数量")
+    memory_parser.set_defaults(func=bench_memory)
+
+    rules_parser = subparsers.add_parser("rules", help="模糊规则引擎随规则数增长的耗时测试")
+    rules_parser.add_argument("--messages", type=int, default=20000, help="不同异常消息的数量")
+    rules_parser.set_defaults(func=bench_rules)
+
+    backfill_parser = subparsers.add_parser("backfill", help="回填模式多进程聚合的扩展测试")
+    backfill_parser.add_argument("--days", type=int, default=56, help="结果文件（天）数")
+    backfill_parser.add_argument("--records-per-day", type=int, default=50000, help="每天的记录数")
+    backfill_parser.add_argument("--distinct", type=int, default=5000, help="不同异常消息的数量")
+    backfill_parser.set_defaults(func=bench_backfill)
+
+    fetch_parser = subparsers.add_parser("fetch", help="在本地替身服务器上测试并发获取数据")
+    fetch_parser.add_argument("--days", type=int, default=14, help="获取的天数")
+    fetch_parser.add_argument("--adaptive", action="store_true", help="按 SlicePlan 拆分失败或被截断的时间窗口")
+    add_mock_server_arguments(fetch_parser)
+    fetch_parser.set_defaults(func=bench_fetch)
+
+    pipeline_parser = subparsers.add_parser("pipeline", help="handle_data 的负载测试：聚合、分类和报表写出")
+    pipeline_parser.add_argument("--records-per-day", type=int, default=100000, help="每天的记录数")
+    pipeline_parser.add_argument("--distinct", type=int, default=5000, help="不同异常消息的数量")
+    pipeline_parser.set_defaults(func=bench_pipeline)
+
+    daemon_parser = subparsers.add_parser("daemon", help="常驻模式与单次运行生成例会报表的耗时对比")
+    add_mock_server_arguments(daemon_parser)
+    daemon_parser.set_defaults(func=bench_daemon)
+
+    serve_parser = subparsers.add_parser("serve", help="单独运行 Dynatrace 替身服务器")
+    serve_parser.add_argument("--port", type=int, default=8080, help="监听端口")
+    serve_parser.add_argument("--work-dir", help="运行主脚本的工作目录，默认新建一个临时目录")
+    add_mock_server_arguments(serve_parser)
+    serve_parser.set_defaults(func=serve)
+
+    memory_child_parser = subparsers.add_parser("memory-child")
+    memory_child_parser.add_argument("--data-dir", required=True)
+    memory_child_parser.add_argument("--mode", choices=["load", "stream"], required=True)
+    memory_child_parser.set_defaults(func=peak_rss_child)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
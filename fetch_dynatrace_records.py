@@ -1,21 +1,100 @@
+import argparse
+import contextlib
+import csv
+import functools
+import hashlib
+import heapq
+import html
+import io
 import json
 import logging
+import mmap
 import os
 import random
 import re
+import shutil
+import struct
+import sys
+import threading
 import time
 import traceback
+import zlib
+from abc import ABC, abstractmethod
+from array import array
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
-from urllib.parse import urlencode
 
-import holidays
-import pandas as pd
-import requests
+# 第三方依赖（requests、holidays、openpyxl）在用到时才导入，只使用分类和聚合功能时启动更快
 
 ##################### 全局变量开始 #####################
 
-# 获取中国节假日
-cn_holidays = holidays.CN()
+# 工作日索引：每年的非工作日只用 holidays 计算一次，之后直接读取
+WORKDAY_INDEX_FILE = "cache/workdays.json"
+# 当年及以后年份的索引超过该天数后重新计算，以便获得 holidays 更新的节假日安排
+WORKDAY_INDEX_MAX_AGE_DAYS = 30
+# 非工作日的计算规则改变时递增，旧版本的索引自动重新计算
+WORKDAY_INDEX_VERSION = 1
+
+
+class WorkdayCalendar:
+    """
+    中国工作日日历
+
+    非工作日就是 holidays.CN 中的日期，与原来的 `previous_day in cn_holidays` 判断相同。
+
+    每年的非工作日用 holidays 计算一次后保存在 index_file 中，之后的运行直接读取，不需要导入 holidays。
+    """
+
+    def __init__(self, index_file=WORKDAY_INDEX_FILE):
+        self.index_file = index_file
+        self.years = None
+
+    def is_workday(self, date):
+        if self.years is None:
+            self.years = self._load()
+        year = self.years.get(str(date.year))
+        if year is None or self._expired(date.year, year):
+            year = self.years[str(date.year)] = self._build_year(date.year)
+            self._save()
+        return date.strftime('%Y-%m-%d') not in year["non_workdays"]
+
+    @staticmethod
+    def _expired(year, entry):
+        if entry.get("version") != WORKDAY_INDEX_VERSION:
+            return True
+        # 往年的节假日安排不会再变化
+        if year < datetime.now().year:
+            return False
+        return datetime.now() - datetime.fromisoformat(entry["built_at"]) > timedelta(days=WORKDAY_INDEX_MAX_AGE_DAYS)
+
+    @staticmethod
+    def _build_year(year):
+        import holidays
+
+        calendar = holidays.CN(years=year)
+        non_workdays = {day.strftime('%Y-%m-%d') for day in calendar}
+        return {"version": WORKDAY_INDEX_VERSION, "built_at": datetime.now().isoformat(), "non_workdays": non_workdays}
+
+    def _load(self):
+        try:
+            with open(self.index_file, 'r', encoding='utf-8') as f:
+                years = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+        for entry in years.values():
+            entry["non_workdays"] = set(entry["non_workdays"])
+        return years
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.index_file), exist_ok=True)
+        years = {year: dict(entry, non_workdays=sorted(entry["non_workdays"])) for year, entry in self.years.items()}
+        tmp_filename = f"{self.index_file}.tmp"
+        with open(tmp_filename, 'w', encoding='utf-8') as f:
+            json.dump(years, f)
+        os.replace(tmp_filename, self.index_file)
+
+
+workday_calendar = WorkdayCalendar()
 
 
 def get_previous_workday(current_date):
@@ -30,47 +109,198 @@ def get_previous_workday(current_date):
         datetime对象，上一个工作日
     """
     previous_day = current_date - timedelta(days=1)
-    # 循环直到找到一个工作日。
-    # 工作日的定义是：
-    # 1. 是周一到周五，且不是法定节假日。
-    # 2. 是周末，但是是调休的工作日（即不在节假日列表中）。
-    #
-    # 所以，非工作日的定义是：
-    # 1. 是法定节假日。
-    # 2. 是周末，且不是调休的工作日（即它就是一个普通的周末，或者本身是节假日）。
-    #    由于调休的周末不在cn_holidays里，所以 `previous_day in cn_holidays` 可以同时覆盖“是法定节假日”和“是普通周末”的情况。
-    while previous_day in cn_holidays:
+    # 循环直到找到一个工作日，工作日的定义见 WorkdayCalendar
+    while not workday_calendar.is_workday(previous_day):
         previous_day -= timedelta(days=1)
     return previous_day
 
 
-def get_workday_dates():
+def get_workday_dates(now=None):
     """
     获取当前日期和上一个工作日的日期
-    
+
+    Args:
+        now: 作为“今天”的时间，默认为当前时间
+
     Returns:
         tuple: (当前日期, 上一个工作日)
     """
-    today = datetime.now()
+    today = now or datetime.now()
     previous_workday = get_previous_workday(today)
 
     return today, previous_workday
 
 
-#  TODO 测试
-# TODAY_STR = "20251014"
-today, previous_workday = get_workday_dates()
-TODAY_STR = today.strftime('%Y%m%d')
-PREVIOUS_WORKDAY_STR = previous_workday.strftime('%Y%m%d')
+class RunContext:
+    """
+    一次运行使用的日期和输出目录
+
+    创建时只计算日期和路径，不访问输出目录；prepare() 时才创建目录。
+    """
+
+    def __init__(self, now=None):
+        self.today, self.previous_workday = get_workday_dates(now)
+        self.today_str = self.today.strftime('%Y%m%d')
+        self.previous_workday_str = self.previous_workday.strftime('%Y%m%d')
+        self.output_dir = f"output/{self.today_str}"
+        self.previous_workday_output_dir = f"output/{self.previous_workday_str}"
+
+    def prepare(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        os.makedirs(self.previous_workday_output_dir, exist_ok=True)
+        return self
 
-OUTPUT_DIR = f"output/{TODAY_STR}"
-PREVIOUS_WORKDAY_OUTPUT_DIR = f"output/{PREVIOUS_WORKDAY_STR}"
 
-os.makedirs(OUTPUT_DIR, exist_ok=True)
-os.makedirs(PREVIOUS_WORKDAY_OUTPUT_DIR, exist_ok=True)
+_run_context = None
 
-# 查询结果轮询间隔（秒）
+
+def get_run_context():
+    """当前运行的上下文，没有设置时按当前时间创建。"""
+    global _run_context
+    if _run_context is None:
+        _run_context = RunContext()
+    return _run_context
+
+
+def set_run_context(context):
+    """设置当前运行的上下文，例如指定其他日期重新生成报表。"""
+    global _run_context
+    _run_context = context
+    return context
+
+
+# 原来的模块级变量改为从当前运行的上下文中读取，只在访问时计算
+_RUN_CONTEXT_ATTRIBUTES = {
+    "today": "today",
+    "previous_workday": "previous_workday",
+    "TODAY_STR": "today_str",
+    "PREVIOUS_WORKDAY_STR": "previous_workday_str",
+    "OUTPUT_DIR": "output_dir",
+    "PREVIOUS_WORKDAY_OUTPUT_DIR": "previous_workday_output_dir",
+}
+
+
+def __getattr__(name):
+    attribute = _RUN_CONTEXT_ATTRIBUTES.get(name)
+    if attribute is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return getattr(get_run_context(), attribute)
+
+
+# 查询结果轮询的最大退避间隔（秒）
 POLL_INTERVAL = 10
+# 退避的初始间隔（秒），之后每次翻倍直到 POLL_INTERVAL
+POLL_BACKOFF_BASE = 0.5
+# 服务端长轮询的等待时间（毫秒）
+POLL_LONG_POLL_MILLISECONDS = 30000
+# 单个查询的轮询超时时间（分钟）
+POLL_TIMEOUT_MINUTES = 6
+# DQL 执行请求失败后的最大重试次数
+EXECUTE_MAX_RETRIES = 3
+# HTTP 连接超时和读取超时（秒），避免连接卡住时轮询循环和常驻模式永远阻塞；
+# 轮询的读取超时在长轮询等待时间之上再加 HTTP_READ_TIMEOUT_SECONDS
+HTTP_CONNECT_TIMEOUT_SECONDS = 10
+HTTP_READ_TIMEOUT_SECONDS = 60
+
+# Dynatrace 租户地址和 DQL 接口路径
+# 可以通过环境变量 DYNATRACE_BASE_URL 指向其他租户或本地的替身服务器（benchmark.py serve）
+DEFAULT_DYNATRACE_BASE_URL = "https://wyv31614.live.dynatrace.com"
+DYNATRACE_BASE_URL = os.environ.get("DYNATRACE_BASE_URL", DEFAULT_DYNATRACE_BASE_URL)
+DQL_EXECUTE_PATH = "/rest/v2/logmonitoring/dql/query:execute"
+DQL_POLL_PATH = "/rest/v2/logmonitoring/dql/query:poll"
+# 可以查询的 Dynatrace 环境：名称 -> 租户地址。默认环境的 cookie 和 csrftoken 位于 resources/，
+# 其他环境位于 resources/{名称}/，查询语句共用 resources/query.txt
+DYNATRACE_ENVIRONMENTS = {
+    "live": DYNATRACE_BASE_URL,
+}
+DEFAULT_ENVIRONMENT = "live"
+
+# 同时进行的 DQL 查询数上限，避免触发 Dynatrace 的限流
+MAX_CONCURRENT_QUERIES = 4
+
+# 获取方式："full" 为单阶段查询，返回所有堆栈跟踪；
+# "two_phase" 先只查询按消息和 app 汇总的数量，再只为前 TWO_PHASE_TOP_N 和新出现的消息查询堆栈跟踪
+FETCH_MODE = "full"
+TWO_PHASE_TOP_N = 200
+# 每天额外查询堆栈跟踪的新消息数上限（按数量取前几条）；本地没有任何已知消息（冷缓存）时不查询新消息
+TWO_PHASE_NEW_MESSAGES_MAX = 50
+
+# 单阶段查询失败或结果被截断时，是否自动把时间窗口拆分为更小的时间片重新查询
+ADAPTIVE_WINDOWS = True
+# 一天最多拆分的层数，每层一分为二
+WINDOW_MAX_SPLIT_DEPTH = 4
+# 查询失败时只有这些状态（查询本身太重）才拆分时间窗口，提交被拒绝等错误直接放弃
+SPLITTABLE_QUERY_STATES = ("FAILED", "TIMED_OUT")
+# 每天使用的时间片数量，下次运行从该粒度开始
+SLICE_PLAN_FILE = "cache/slice_plan.json"
+
+# DQL 查询使用的时区
+QUERY_TIMEZONE = "Asia/Shanghai"
+
+# 每次运行的性能指标文件，与 summary.xlsx 位于同一目录
+RUN_METRICS_FILE = "run_metrics.json"
+# --profile 模式下日志中输出的函数数量（按累计耗时排序）
+PROFILE_TOP_FUNCTIONS = 30
+# 比较两次运行的性能指标时，耗时超过基线的倍数且多出的秒数超过下限才视为退化
+METRICS_REGRESSION_RATIO = 1.5
+METRICS_REGRESSION_MIN_SECONDS = 1.0
+
+# 回填模式：并行聚合使用的进程数，None 表示使用全部 CPU 核心
+BACKFILL_WORKERS = None
+# 每个进程分到的分片数，分片越多负载越均衡，但需要合并的部分结果也越多
+BACKFILL_SHARDS_PER_WORKER = 2
+# 回填报表中每个统计周期的天数
+BACKFILL_PERIOD_DAYS = 7
+# 回填结果的保存目录
+BACKFILL_OUTPUT_DIR = "output/backfill"
+
+# 常驻模式：本地 HTTP 服务监听的地址和端口
+DAEMON_HOST = "127.0.0.1"
+DAEMON_PORT = 8765
+# 常驻模式检查是否有新窗口可以获取的间隔（秒）
+DAEMON_CHECK_SECONDS = 60
+# 进行中的 10:00→10:00 窗口按多少小时切片获取，需要能整除 24
+DAEMON_SLICE_HOURS = 1
+# 时间片或整天窗口结束后等待多少分钟再查询，给 Dynatrace 留出数据写入的时间
+DAEMON_FETCH_DELAY_MINUTES = 5
+# 查询失败后等待多少分钟再重试同一个窗口
+DAEMON_RETRY_MINUTES = 10
+
+# 按天缓存 DQL 查询结果，跨多次运行复用已获取的日期
+DAY_CACHE_DIR = "cache/days"
+# 时间窗口结束多少小时后认为数据已完整（Grail 数据写入存在延迟），完整的天可以永久复用
+DAY_CACHE_SETTLE_HOURS = 2
+# 未完整的天的缓存有效期（小时），过期后重新查询
+DAY_CACHE_INCOMPLETE_TTL_HOURS = 1
+# 缓存条目最后一次访问超过多少天后被淘汰
+DAY_CACHE_MAX_AGE_DAYS = 60
+# 缓存总大小上限（字节），超出后按最近最少使用淘汰
+DAY_CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+# 是否在聚合时同时生成 merged_current_7_days.json 和 merged_previous_workday_7_days.json
+WRITE_MERGED_FILES = False
+# 每天查询结果的存储格式："columnar" 为字典编码的列式二进制文件，"json" 为 JSON 数组
+DAY_FILE_FORMAT = "columnar"
+DAY_FILE_SUFFIXES = {
+    "columnar": ".dcol",
+    "json": ".json",
+}
+# 列式文件的魔数和头部长度字段格式
+COLUMNAR_MAGIC = b"DQLCOL1\n"
+_COLUMNAR_HEADER_LENGTH = struct.Struct("<I")
+# 是否基于每天的聚合快照增量计算7天窗口（WRITE_MERGED_FILES 打开时需要读取全部记录，不使用增量计算）
+INCREMENTAL_AGGREGATION = True
+# 快照和窗口状态的格式版本，格式变化后旧文件自动失效
+SNAPSHOT_VERSION = 2
+# 每天聚合快照和7天窗口聚合状态的保存目录
+SNAPSHOT_DIR = "cache/snapshots"
+WINDOW_STATE_DIR = "cache/windows"
+# 保留的窗口聚合状态数量
+MAX_WINDOW_STATES = 4
+# 流式读取 JSON 文件时每次读取的字符数
+STREAM_CHUNK_SIZE = 1024 * 1024
+# 流式解析时跳过记录之间的空白和逗号
+_JSON_SEPARATOR = re.compile(r'[\s,]*')
 
 # 异常消息的分类规则，定义为正则表达式模式
 # 可以根据需要扩展规则
@@ -103,21 +333,74 @@ FUZZY_RULES = [
     r"Failed unlocking: Lock not found\. Name: .*, LockClass: .*",
 ]
 
+# 规则引擎按字面量前缀的前几个字符建立索引
+FUZZY_RULE_PREFIX_LENGTH = 4
+# 消息分类结果的 LRU 缓存条数
+FUZZY_RULE_CACHE_SIZE = 65536
+
+# 是否对未命中 FUZZY_RULES 的消息自动挖掘模板（ID、十六进制串、IP、主机名、数字替换为通配符后聚类）
+ENABLE_TEMPLATE_MINING = True
+# 模板前缀树按前几个词元分组
+TEMPLATE_PREFIX_TOKENS = 2
+# 消息与模板相同词元（模板中的通配符视为相同）的比例达到该值时归入该模板。
+# 1.0 表示只有 TEMPLATE_MASKS 屏蔽掉的可变部分可以不同，措辞不同的消息（例如 card was declined 与
+# card has expired）不会合并；调低后会按 Drain 的方式合并相似的消息，报表的行也会随之变化
+TEMPLATE_SIMILARITY = 1.0
+# 前缀树每个节点的最大子节点数，超出后归入通配符分支
+TEMPLATE_MAX_CHILDREN = 100
+TEMPLATE_WILDCARD = "<*>"
+# 挖掘模板前按顺序替换为通配符的可变部分
+TEMPLATE_MASKS = [
+    # UUID
+    re.compile(r"\b[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\b", re.IGNORECASE),
+    # IPv4 地址（可带端口）
+    re.compile(r"\b\d{1,3}(?:\.\d{1,3}){3}(?::\d+)?\b"),
+    # 主机名，例如 infra-prd-td-us-1-gener-shard-00-04.9c2kr.mongodb.net:27017
+    re.compile(r"\b(?:[a-z0-9-]+\.){2,}[a-z]{2,}(?::\d+)?\b", re.IGNORECASE),
+    # Twilio SID，例如 CA3fefa01bd417d244e1fa1c21bd88a105
+    re.compile(r"\b[A-Z]{2}[0-9a-f]{32}\b"),
+    # 含数字的十六进制串，例如 Mongo ObjectId、锁名
+    re.compile(r"\b(?:0x)?(?=[0-9a-f]*\d)[0-9a-f]{8,}\b", re.IGNORECASE),
+    # 数字
+    re.compile(r"(?<!\w)\d+(?:\.\d+)?"),
+]
 
-##################### 全局变量结束 #####################
+# 报表输出格式，可以同时输出多种：xlsx、csv、html、parquet（需要安装 pyarrow）
+REPORT_FORMATS = ["xlsx"]
+# Excel 单元格最多保存的字符数
+EXCEL_CELL_MAX_CHARS = 32767
+# 超出单元格上限的完整文本保存目录，相对于报表所在目录
+REPORT_OVERFLOW_DIR = "overflow"
+# Parquet 每批写出的行数
+PARQUET_BATCH_ROWS = 10000
+
+# 报表中堆栈跟踪的数量统计使用的数据集
+STACKTRACE_COUNT_FIELD = "current_7_days_count"
+# 堆栈跟踪指纹的长度（十六进制字符数）
+STACKTRACE_FINGERPRINT_LENGTH = 12
+# 报表单元格中每个指纹展示的堆栈跟踪行数
+STACKTRACE_PREVIEW_LINES = 5
+# 计算指纹前对每一行调用帧做的规范化：对象地址、含数字的长十六进制串（线程号、对象 ID）、独立的数字（行号等），
+# 标识符中的数字（例如 v2、model_1）保留
+STACKTRACE_NORMALIZERS = [
+    (re.compile(r"0x[0-9a-f]+", re.IGNORECASE), "0x?"),
+    (re.compile(r"\b(?=[0-9a-f]*\d)[0-9a-f]{8,}\b", re.IGNORECASE), "?"),
+    (re.compile(r"(?<!\w)\d+"), "?"),
+]
 
 
-def setup_logging():
+def setup_logging(context=None):
     """配置日志记录到文件和控制台。"""
+    context = context or get_run_context()
     os.makedirs('logs', exist_ok=True)
-    log_filename = f"logs/log_{TODAY_STR}.log"
+    log_filename = f"logs/log_{context.today_str}.log"
     logging.basicConfig(
         level=logging.INFO,
         handlers=[
             logging.FileHandler(log_filename, encoding='utf-8'),
             logging.StreamHandler()
         ],
-        format='%(asctime)s - %(levelname)s - %(message)s'
+        format='%(asctime)s - %(levelname)s - [%(threadName)s] %(message)s'
     )
     return log_filename
 
@@ -131,261 +414,2064 @@ agents = [
 ]
 
 
-def make_request(query, cookie, csrftoken, start_time_str, end_time_str, day_num, output_dir):
+def peak_memory_mb(children=False):
+    """
+    当前进程的峰值常驻内存（MB）；children 为 True 时返回已结束的子进程中峰值最大的一个
+
+    Returns:
+        float: 不支持的平台（Windows 没有 resource 模块）返回 None
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    # macOS 上 ru_maxrss 的单位是字节，Linux 上是 KB
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+class RunMetrics:
+    """
+    一次运行的性能指标：各阶段耗时、计数器和峰值内存
+
+    同名阶段的耗时累加，并记录调用次数和单次最大耗时；阶段可以嵌套，也可以在多个线程中同时计时，
+    所以并发阶段（例如 http.poll）的累计耗时可能超过整体运行时间。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started_at = datetime.now()
+            self.started = time.perf_counter()
+            self.stages = {}
+            self.counters = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - started)
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = {"calls": 0, "seconds": 0.0, "max_seconds": 0.0}
+            stage["calls"] += 1
+            stage["seconds"] += seconds
+            stage["max_seconds"] = max(stage["max_seconds"], seconds)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "started_at": self.started_at.isoformat(),
+                "wall_seconds": round(time.perf_counter() - self.started, 3),
+                "peak_memory_mb": peak_memory_mb(),
+                "peak_children_memory_mb": peak_memory_mb(children=True),
+                "stages": {
+                    name: {"calls": stage["calls"], "seconds": round(stage["seconds"], 3),
+                           "max_seconds": round(stage["max_seconds"], 3)}
+                    for name, stage in sorted(self.stages.items())
+                },
+                "counters": dict(sorted(self.counters.items())),
+            }
+
+    def write(self, output_dir):
+        """把指标写到 output_dir 下的 RUN_METRICS_FILE，返回文件名。"""
+        filename = f"{output_dir}/{RUN_METRICS_FILE}"
+        metrics = self.to_dict()
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump(metrics, f, indent=4, ensure_ascii=False)
+        logging.info(f"运行耗时 {metrics['wall_seconds']:.1f} 秒，性能指标已保存到 {filename}")
+        return filename
+
+
+# 全局运行指标
+run_metrics = RunMetrics()
+
+# 限制同时进行的 DQL 查询数，时间片拆分产生的子查询也受此限制
+query_slots = threading.BoundedSemaphore(MAX_CONCURRENT_QUERIES)
+
+# 每个查询的耗时拆分，{day_num: {"submit": 秒, "queued": 秒, "running": 秒, "downloading": 秒}}
+query_latencies = {}
+
+
+def backoff_delay(attempt):
+    """
+    计算带随机抖动的指数退避间隔
+
+    Args:
+        attempt: 连续失败或未命中长轮询的次数，从 1 开始
+
+    Returns:
+        float: 等待秒数，不超过 POLL_INTERVAL
+    """
+    cap = min(POLL_INTERVAL, POLL_BACKOFF_BASE * (2 ** (attempt - 1)))
+    return cap / 2 + random.uniform(0, cap / 2)
+
+
+class DynatraceClient:
+    """
+    Dynatrace DQL 接口的共享 HTTP 客户端
+
+    所有请求共用一个带连接池的 Session，复用 keep-alive 的 TCP/TLS 连接；
+    认证请求头（cookie、csrftoken、User-Agent）每次运行只构建一次；
+    协商 gzip/br 压缩传输，轮询结果以流的方式边下载边解码。
+    base_url 可以指向本地的替身服务器，方便离线测试；默认使用创建客户端时的 DYNATRACE_BASE_URL。
+    """
+
+    def __init__(self, cookie, csrftoken, base_url=None, pool_size=MAX_CONCURRENT_QUERIES):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.request import ACCEPT_ENCODING
+
+        self.base_url = (base_url or DYNATRACE_BASE_URL).rstrip('/')
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_size))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "User-Agent": random.choice(agents),
+            "x-csrftoken": csrftoken,
+            "cookie": cookie,
+            "Accept": "application/json",
+            # urllib3 只会在安装了 brotli 时声明支持 br
+            "Accept-Encoding": ACCEPT_ENCODING,
+        })
+
+    def execute(self, body):
+        """调用 query:execute 提交 DQL 查询，返回响应 JSON。"""
+        with run_metrics.stage("http.execute"):
+            response = self.session.post(f"{self.base_url}{DQL_EXECUTE_PATH}", json=body,
+                                         timeout=(HTTP_CONNECT_TIMEOUT_SECONDS, HTTP_READ_TIMEOUT_SECONDS))
+            response.raise_for_status()
+            return response.json()
+
+    def poll(self, request_token, timeout_milliseconds=POLL_LONG_POLL_MILLISECONDS):
+        """
+        调用 query:poll 获取查询状态和结果
+
+        Returns:
+            tuple: (响应对象, 响应 JSON)，响应对象的 elapsed 为收到响应头的耗时
+        """
+        params = {
+            "request-token": request_token,
+            "request-timeout-milliseconds": timeout_milliseconds,
+        }
+        # 读取超时作用于每次从连接读取数据，流式下载大结果时不会因为总耗时长而超时
+        timeout = (HTTP_CONNECT_TIMEOUT_SECONDS, timeout_milliseconds / 1000 + HTTP_READ_TIMEOUT_SECONDS)
+        with run_metrics.stage("http.poll"), \
+                self.session.get(f"{self.base_url}{DQL_POLL_PATH}", params=params, stream=True,
+                                 timeout=timeout) as response:
+            response.raise_for_status()
+            return response, self._read_json(response)
+
+    @staticmethod
+    def _read_json(response):
+        import requests
+        import urllib3
+
+        # 直接从底层连接流式解压和解析，避免同时保留压缩包、字节串和字符串三份结果
+        response.raw.decode_content = True
+        try:
+            with run_metrics.stage("json.parse"):
+                return json.load(io.TextIOWrapper(response.raw, encoding=response.encoding or 'utf-8'))
+        except (urllib3.exceptions.HTTPError, ValueError) as e:
+            raise requests.RequestException(f"读取 DQL 响应失败：{e}") from e
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+def submit_query(client, api1_body, day_num):
+    """
+    提交 DQL 执行请求，网络错误、429 和 5xx 响应按指数退避重试，最多重试 EXECUTE_MAX_RETRIES 次
+
+    Returns:
+        dict: query:execute 的响应
+    """
+    import requests
+
+    for attempt in range(1, EXECUTE_MAX_RETRIES + 2):
+        try:
+            logging.info("正在发送第 %s 天的 DQL 执行请求...", day_num)
+            return client.execute(api1_body)
+        except requests.RequestException as e:
+            status_code = e.response.status_code if e.response is not None else None
+            retryable = status_code is None or status_code == 429 or status_code >= 500
+            if not retryable or attempt > EXECUTE_MAX_RETRIES:
+                raise
+            run_metrics.count("http.execute_retries")
+            delay = backoff_delay(attempt)
+            logging.warning("第 %s 天的 DQL 执行请求失败（%s），%.1f 秒后进行第 %d 次重试", day_num, e, delay, attempt)
+            time.sleep(delay)
+
+
+def run_query(client, query, start_time_str, end_time_str, label):
+    """
+    执行一个 DQL 查询并轮询直到完成
+
+    Args:
+        label: 日志和 query_latencies 中标识该查询的名称
+
+    Returns:
+        dict: 成功时返回响应中的 result（包含 records 和 metadata），失败或超时返回 None
+    """
+    return run_query_with_status(client, query, start_time_str, end_time_str, label)[0]
+
+
+def run_query_with_status(client, query, start_time_str, end_time_str, label):
+    """
+    与 run_query 相同，同时返回查询的最终状态，调用方据此判断失败后是否值得拆分时间窗口重试
+
+    Returns:
+        tuple: (result, status)，status 为 "SUCCEEDED"、"FAILED"、"CANCELLED"、"RESULT_GONE"、"TIMED_OUT"、
+               "REJECTED"（提交被 4xx 拒绝，例如 cookie 过期）或 "ERROR"（网络错误、响应缺少 requestToken 等）；
+               失败时 result 为 None
+    """
+    with query_slots:
+        return _run_query(client, query, start_time_str, end_time_str, label)
+
+
+def _run_query(client, query, start_time_str, end_time_str, label):
+    import requests
+
     # 执行 DQL 请求
-    api1_url = "https://wyv31614.live.dynatrace.com/rest/v2/logmonitoring/dql/query:execute"
-    user_agent = random.choice(agents)
-    api1_headers = {
-        "User-Agent": user_agent,
-        "x-csrftoken": csrftoken,
-        "cookie": cookie,
-    }
     api1_body = {
         "query": query,
         "defaultTimeframeStart": start_time_str,
         "defaultTimeframeEnd": end_time_str,
         "requestTimeoutMilliseconds": 1,
         "maxResultBytes": 64000000,
-        "timezone": "Asia/Shanghai",
+        "timezone": QUERY_TIMEZONE,
     }
 
     try:
-        logging.info("正在发送 DQL 执行请求...")
-        response1 = requests.post(api1_url, headers=api1_headers, json=api1_body)
-        response1.raise_for_status()
-        api1_result = response1.json()
-
-        output_filename = f'{output_dir}/dql_result_for_day_{day_num}.json'
+        submit_started = time.monotonic()
+        api1_result = submit_query(client, api1_body, label)
+        submitted_at = time.monotonic()
 
         request_token = api1_result.get("requestToken")
 
         logging.info("DQL 执行请求成功，响应已保存，requestToken=%s", request_token)
         if not request_token:
             logging.error("DQL 执行响应中未找到 requestToken。")
-            return None
+            return None, "ERROR"
 
-        # 轮询执行结果
-        request_token = urlencode({'': request_token})[1:]
-        api2_url = f"https://wyv31614.live.dynatrace.com/rest/v2/logmonitoring/dql/query:poll?request-token={request_token}&request-timeout-milliseconds=30000"
-        start_time = datetime.now()
-        timeout = timedelta(minutes=6)
+        # 轮询执行结果：优先依赖服务端长轮询，服务端提前返回或出错时退回到带抖动的指数退避
+        timeout = POLL_TIMEOUT_MINUTES * 60
+        running_since = submitted_at if api1_result.get("state") == "RUNNING" else None
+        attempt = 0
 
-        while datetime.now() - start_time < timeout:
+        while time.monotonic() - submitted_at < timeout:
+            poll_started = time.monotonic()
             try:
-                logging.info("正在轮询 DQL 执行结果...")
-                response2 = requests.get(api2_url, headers=api1_headers)
-                response2.raise_for_status()
-                api2_result = response2.json()
-
-                state = api2_result.get("state")
-                if state == "SUCCEEDED":
-                    logging.info("DQL 执行结果成功。")
-
-                    records = api2_result.get("result", {}).get("records", [])
-                    with open(output_filename, 'w') as f:
-                        json.dump(records, f, indent=4)
-
-                    execution_time_milliseconds = api2_result.get("result", {}).get("metadata", {}).get("grail",
-                                                                                                        {}).get(
-                        "executionTimeMilliseconds", {})
-                    if execution_time_milliseconds:
-                        # 将执行时间毫秒转换为分钟
-                        logging.info("分析时间范围持续时间：%.2f 分钟", execution_time_milliseconds / 60000)
-                    scanned_bytes = api2_result.get("result", {}).get("metadata", {}).get("grail", {}).get(
-                        "scannedBytes")
-                    if scanned_bytes:
-                        # 将字节转换为 TB 用于日志记录
-                        scanned_tb = scanned_bytes / (1024 ** 4)
-                        logging.info("扫描数据大小：%.2f TB", scanned_tb)
-
-                    logging.info("DQL 执行结果已保存到 %s", output_filename)
-                    return output_filename
-
-                logging.info(f"DQL 执行状态：{state}。{POLL_INTERVAL} 秒后重试...")
-                time.sleep(POLL_INTERVAL)
-
-            except requests.RequestException as e:
-                logging.error(f"轮询 DQL 执行结果时出错：{traceback.print_exc()}")
-
-        logging.error("轮询 DQL 执行结果在 6 分钟后超时。")
+                logging.info("正在轮询第 %s 天的 DQL 执行结果...", label)
+                run_metrics.count("dql.polls")
+                response2, api2_result = client.poll(request_token)
+            except requests.RequestException:
+                run_metrics.count("dql.poll_errors")
+                attempt += 1
+                delay = backoff_delay(attempt)
+                logging.error(f"轮询 DQL 执行结果时出错，{delay:.1f} 秒后重试：{traceback.format_exc()}")
+                time.sleep(delay)
+                continue
+
+            state = api2_result.get("state")
+            if state == "SUCCEEDED":
+                logging.info("DQL 执行结果成功。")
+                finished_at = time.monotonic()
+                # 收到响应头之后的时间视为下载和解析结果的耗时
+                downloading = max(0.0, finished_at - poll_started - response2.elapsed.total_seconds())
+                running_since = running_since or submitted_at
+                query_latencies[label] = {
+                    "submit": submitted_at - submit_started,
+                    "queued": running_since - submitted_at,
+                    "running": finished_at - downloading - running_since,
+                    "downloading": downloading,
+                }
+                logging.info("第 %s 天查询耗时：提交 %.2f 秒，排队 %.2f 秒，运行 %.2f 秒，下载 %.2f 秒",
+                             label, *query_latencies[label].values())
+                for phase, seconds in query_latencies[label].items():
+                    run_metrics.add_time(f"dql.{phase}", seconds)
+                run_metrics.count("dql.succeeded")
+                run_metrics.count("dql.records", len(api2_result.get("result", {}).get("records", [])))
+
+                execution_time_milliseconds = api2_result.get("result", {}).get("metadata", {}).get("grail",
+                                                                                                    {}).get(
+                    "executionTimeMilliseconds", {})
+                if execution_time_milliseconds:
+                    run_metrics.count("dql.execution_milliseconds", execution_time_milliseconds)
+                    # 将执行时间毫秒转换为分钟
+                    logging.info("分析时间范围持续时间：%.2f 分钟", execution_time_milliseconds / 60000)
+                scanned_bytes = api2_result.get("result", {}).get("metadata", {}).get("grail", {}).get(
+                    "scannedBytes")
+                if scanned_bytes:
+                    run_metrics.count("dql.scanned_bytes", scanned_bytes)
+                    # 将字节转换为 TB 用于日志记录
+                    scanned_tb = scanned_bytes / (1024 ** 4)
+                    logging.info("扫描数据大小：%.2f TB", scanned_tb)
+
+                return api2_result.get("result", {}), state
+
+            if state in ("FAILED", "CANCELLED", "RESULT_GONE"):
+                run_metrics.count("dql.failed")
+                logging.error("第 %s 天的 DQL 执行状态：%s，放弃轮询。", label, state)
+                return None, state
+
+            if state == "RUNNING" and running_since is None:
+                running_since = time.monotonic()
+
+            # 长轮询等满了说明服务端在正常挂起请求，立即发起下一次轮询；否则退避等待
+            if time.monotonic() - poll_started >= POLL_LONG_POLL_MILLISECONDS / 1000 * 0.9:
+                attempt = 0
+                logging.info(f"DQL 执行状态：{state}。继续长轮询...")
+            else:
+                attempt += 1
+                delay = backoff_delay(attempt)
+                logging.info(f"DQL 执行状态：{state}。{delay:.1f} 秒后重试...")
+                time.sleep(delay)
+
+        run_metrics.count("dql.timed_out")
+        logging.error(f"轮询 DQL 执行结果在 {POLL_TIMEOUT_MINUTES} 分钟后超时。")
+        return None, "TIMED_OUT"
 
     except requests.RequestException as e:
         logging.error(f"执行 DQL 请求时出错：{e}")
         logging.error(traceback.format_exc())
+        # 轮询中的网络错误会在循环内重试，到这里的都是提交失败；除 429 以外的 4xx 重试或拆分都不会成功
+        status_code = e.response.status_code if e.response is not None else None
+        if status_code is not None and 400 <= status_code < 500 and status_code != 429:
+            return None, "REJECTED"
+        return None, "ERROR"
 
-    return None
 
+def make_request(client, query, start_time_str, end_time_str, day_num, output_dir, slice_plan=None):
+    """
+    执行一天的 DQL 查询并把记录写入 output_dir 中的 dql_result_for_day_{day_num} 文件
 
-def handle_data():
-    # 聚合：合并输出目录中的所有 JSON 文件
-    # 今天往前推7天的数据
-    records_current_7_days = []
-    for day in range(1, 8):
-        with open(f"{OUTPUT_DIR}/dql_result_for_day_{day}.json", 'r') as f:
-            day_records = json.load(f)
-            records_current_7_days.extend(day_records)
-    output_filename_current = f"{OUTPUT_DIR}/merged_current_7_days.json"
-    with open(output_filename_current, 'w') as f:
-        json.dump(records_current_7_days, f, indent=4)
-    logging.info(f"已合并今天往前推7天的数据到 {output_filename_current}")
+    传入 slice_plan 时按计划的粒度切分时间片查询，失败或被截断的时间片继续拆分，
+    并把最终使用的粒度记录到计划中。
+
+    Returns:
+        str: 成功时返回结果文件名，失败返回 None
+    """
+    if slice_plan is None:
+        result = run_query(client, query, start_time_str, end_time_str, day_num)
+        if result is None:
+            return None
+        if is_result_truncated(result):
+            logging.warning("第 %s 天的查询结果被截断，计数可能偏少", day_num)
+        records = result.get("records", [])
+    else:
+        slices = slice_plan.initial_slices(day_num)
+        depth = slices.bit_length() - 1
+        windows = split_window(start_time_str, end_time_str, slices)
+        if slices > 1:
+            logging.info("第 %s 天按计划拆分为 %d 个时间片查询", day_num, slices)
+        outcomes = run_concurrently(
+            lambda index, window: fetch_records_adaptive(client, query, *window, f"{day_num}.{index + 1}", depth),
+            list(enumerate(windows)),
+        )
+        if any(outcome is None for outcome in outcomes):
+            return None
+        records = merge_partial_records(records for records, _ in outcomes) if slices > 1 else outcomes[0][0]
+        slice_plan.record(day_num, 2 ** max(finest for _, finest in outcomes))
+
+    output_filename = day_filename(output_dir, day_num)
+    write_day_records(records, output_filename)
+    logging.info("DQL 执行结果已保存到 %s", output_filename)
+    return output_filename
+
+
+def run_concurrently(function, items):
+    """在独立的线程池中对每个元素调用 function(*item)，按输入顺序返回结果。实际查询数仍受 query_slots 限制。"""
+    if len(items) == 1:
+        return [function(*items[0])]
+    with ThreadPoolExecutor(max_workers=len(items), thread_name_prefix="dql-slice") as executor:
+        return list(executor.map(lambda item: function(*item), items))
+
+
+def fetch_records_adaptive(client, query, start_time_str, end_time_str, label, depth=0):
+    """
+    查询一个时间片，超时、FAILED 或结果被截断时一分为二并发查询，再合并部分结果；
+    其他失败（例如 cookie 过期导致提交被拒绝）不拆分，直接返回 None
+
+    最多拆分到 WINDOW_MAX_SPLIT_DEPTH 层（一天最多 2^WINDOW_MAX_SPLIT_DEPTH 个时间片）。
+
+    Returns:
+        tuple: (记录列表, 实际达到的最深拆分层数)，失败返回 None
+    """
+    result, status = run_query_with_status(client, query, start_time_str, end_time_str, label)
+    if result is not None and not is_result_truncated(result):
+        return result.get("records", []), depth
+    if result is None and status not in SPLITTABLE_QUERY_STATES:
+        logging.error("%s 查询失败（%s），拆分时间窗口也无法解决，不再重试", label, status)
+        return None
+    if depth >= WINDOW_MAX_SPLIT_DEPTH:
+        if result is None:
+            logging.error("%s 拆分 %d 层后仍然失败", label, depth)
+            return None
+        logging.warning("%s 拆分 %d 层后结果仍被截断，计数可能偏少", label, depth)
+        return result.get("records", []), depth
+
+    reason = "失败" if result is None else "结果被截断"
+    logging.warning("%s（%s ~ %s）%s，拆分为两个时间片重新查询", label, start_time_str, end_time_str, reason)
+    outcomes = run_concurrently(
+        lambda index, window: fetch_records_adaptive(client, query, *window, f"{label}.{index + 1}", depth + 1),
+        list(enumerate(split_window(start_time_str, end_time_str))),
+    )
+    if any(outcome is None for outcome in outcomes):
+        return None
+    return merge_partial_records(records for records, _ in outcomes), max(finest for _, finest in outcomes)
+
+
+class SlicePlan:
+    """
+    持久化每天查询使用的时间片数量，下次运行直接从合适的粒度开始
+
+    没有记录的日期沿用前一天的粒度减半，繁忙时期的粒度会延续下去，平稳后逐渐恢复为整天查询。
+    """
+
+    def __init__(self, filename=SLICE_PLAN_FILE):
+        self.filename = filename
+        self.lock = threading.Lock()
+        try:
+            with open(filename, 'r') as f:
+                self.plan = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.plan = {}
+
+    def initial_slices(self, day_key):
+        """
+        Args:
+            day_key: 日期，格式为 YYYYMMDD
+
+        Returns:
+            int: 时间片数量，为 2 的幂
+        """
+        with self.lock:
+            if day_key in self.plan:
+                return self.plan[day_key]
+            previous_key = (datetime.strptime(day_key, "%Y%m%d") - timedelta(days=1)).strftime("%Y%m%d")
+            return max(1, self.plan.get(previous_key, 1) // 2)
+
+    def record(self, day_key, slices):
+        with self.lock:
+            if self.plan.get(day_key) == slices:
+                return
+            self.plan[day_key] = slices
+            if slices > 1:
+                logging.info("第 %s 天的时间片计划更新为 %d 片", day_key, slices)
+            os.makedirs(os.path.dirname(self.filename) or ".", exist_ok=True)
+            with open(self.filename, 'w') as f:
+                json.dump(self.plan, f, indent=4, sort_keys=True)
+
+
+def is_result_truncated(result):
+    """根据 Grail 返回的通知判断查询结果是否因 maxResultBytes 等限制被截断。"""
+    notifications = result.get("metadata", {}).get("grail", {}).get("notifications") or []
+    for notification in notifications:
+        notification_type = (notification.get("notificationType") or "").upper()
+        if "TRUNCAT" in notification_type or "LIMIT" in notification_type:
+            return True
+    return False
+
+
+def split_window(start_time_str, end_time_str, parts=2):
+    """
+    把时间窗口等分为 parts 段
+
+    Returns:
+        list: [(开始, 结束), ...]，时间字符串格式与输入一致
+    """
+    start = datetime.fromisoformat(start_time_str)
+    step = (datetime.fromisoformat(end_time_str) - start) / parts
+    bounds = [start_time_str]
+    bounds += [(start + step * i).strftime("%Y-%m-%dT%H:%M:%S.000") for i in range(1, parts)]
+    bounds.append(end_time_str)
+    return list(zip(bounds, bounds[1:]))
+
+
+def merge_partial_records(record_lists):
+    """
+    合并多个不重叠时间片的 summarize 结果，得到与整个窗口一次查询相同的记录
+
+    分组字段相同的记录合并为一条：count() 求和，min(...) 取最小值，max(...) 取最大值。
+
+    Returns:
+        list: 合并后的记录
+    """
+    merged = {}
+    for records in record_lists:
+        for record in records:
+            key = tuple((name, value) for name, value in record.items()
+                        if name != "count()" and not name.startswith(("min(", "max(")))
+            target = merged.get(key)
+            if target is None:
+                merged[key] = dict(record, **{"count()": int(record.get("count()", 0))})
+                continue
+            for name, value in record.items():
+                if name == "count()":
+                    target[name] += int(value)
+                elif value is not None and name.startswith(("min(", "max(")):
+                    current = target.get(name)
+                    if current is None or (value < current if name.startswith("min(") else value > current):
+                        target[name] = value
+    return list(merged.values())
+
+
+def split_query_pipeline(query):
+    """
+    把查询拆成过滤管道和最后的 summarize 命令，两阶段查询共用过滤管道
+
+    Returns:
+        tuple: (过滤管道, summarize 命令)，查询中没有 summarize 时返回 None
+    """
+    index = query.rfind("| summarize")
+    if index < 0:
+        return None
+    return query[:index].rstrip(), query[index:].strip()
+
+
+def dql_string(value):
+    """把字符串转为 DQL 字符串字面量，DQL 与 JSON 使用相同的转义规则。"""
+    return json.dumps(value, ensure_ascii=False)
+
+
+def fetch_message_counts(client, pipeline, start_time_str, end_time_str, label):
+    """
+    第一阶段：只按 app 和异常消息汇总数量，不返回堆栈跟踪
+
+    与单阶段查询一样通过 fetch_records_adaptive 执行：失败（FAILED、超时）或结果被截断时拆分时间窗口，
+    提交被拒绝等其他失败直接返回 None，不会把失败的一天保存为空结果。
+
+    Returns:
+        list: 记录列表，失败返回 None
+    """
+    query = (f"{pipeline}\n| summarize {{count(), min(start_time)}}, "
+             f"by:{{app, span.events.exception.message}}")
+    outcome = fetch_records_adaptive(client, query, start_time_str, end_time_str, label)
+    return None if outcome is None else outcome[0]
+
+
+def fetch_message_stacktraces(client, pipeline, summarize, messages, start_time_str, end_time_str, label):
+    """
+    第二阶段：只为指定消息执行原查询的 summarize，得到与单阶段查询相同的记录，
+    每条记录带有该 app、消息和堆栈跟踪组合自己的 count()
+
+    每天只发送一个查询，失败或结果被截断时同样由 fetch_records_adaptive 拆分时间窗口。
+
+    Returns:
+        list: 记录列表，失败返回 None
+    """
+    if not messages:
+        return []
+    values = ", ".join(dql_string(message) for message in messages)
+    query = f"{pipeline}\n| filter in(span.events.exception.message, array({values}))\n{summarize}"
+    outcome = fetch_records_adaptive(client, query, start_time_str, end_time_str, f"{label}-stacktraces")
+    return None if outcome is None else outcome[0]
+
+
+def make_two_phase_request(client, query, start_time_str, end_time_str, day_num, output_dir,
+                           known_messages=frozenset()):
+    """
+    两阶段获取一天的数据：先查询按消息和 app 汇总的数量，再只为数量前 TWO_PHASE_TOP_N 的消息
+    和 known_messages 中没有的新消息（最多 TWO_PHASE_NEW_MESSAGES_MAX 条）执行原查询，得到带堆栈跟踪的记录。
+    这些消息使用第二阶段的记录（每个堆栈跟踪的数量准确），其他消息使用第一阶段的记录，堆栈跟踪为 None。
+
+    Args:
+        known_messages: 已知的异常消息，不在其中的消息视为新消息；为空（冷缓存）时只查询前 TWO_PHASE_TOP_N 条
+
+    Returns:
+        str: 成功时返回结果文件名，失败返回 None
+    """
+    parts = split_query_pipeline(query)
+    if parts is None:
+        logging.warning("查询中没有 summarize 命令，第 %s 天退回到单阶段查询", day_num)
+        return make_request(client, query, start_time_str, end_time_str, day_num, output_dir)
+    pipeline, summarize = parts
+
+    count_records = fetch_message_counts(client, pipeline, start_time_str, end_time_str, day_num)
+    if count_records is None:
+        return None
+
+    totals = {}
+    for record in count_records:
+        message = record.get("span.events.exception.message")
+        totals[message] = totals.get(message, 0) + int(record.get("count()", 0))
+    ranked = [message for message in sorted(totals, key=totals.get, reverse=True) if message]
+    selected = ranked[:TWO_PHASE_TOP_N]
+    if known_messages:
+        new_messages = [message for message in ranked[TWO_PHASE_TOP_N:] if message not in known_messages]
+        selected += new_messages[:TWO_PHASE_NEW_MESSAGES_MAX]
+    logging.info("第 %s 天共 %d 种消息，查询其中 %d 种的堆栈跟踪", day_num, len(totals), len(selected))
+
+    stacktrace_records = fetch_message_stacktraces(client, pipeline, summarize, selected,
+                                                   start_time_str, end_time_str, day_num)
+    if stacktrace_records is None:
+        return None
+
+    selected = set(selected)
+    records = [dict(record, **{"span.events.exception.stack_trace": None})
+               for record in count_records
+               if record.get("span.events.exception.message") not in selected]
+    records.extend(stacktrace_records)
+
+    output_filename = day_filename(output_dir, day_num)
+    write_day_records(records, output_filename)
+    logging.info("DQL 两阶段查询结果已保存到 %s", output_filename)
+    return output_filename
+
+
+def collect_known_messages(filenames):
+    """读取已有的结果文件，返回其中出现过的所有异常消息。"""
+    messages = set()
+    for filename in filenames:
+        for record in iter_day_records(filename):
+            messages.add(record.get("span.events.exception.message"))
+    return messages
+
+
+def fetch_windows(client, query, windows, output_dir, max_workers=MAX_CONCURRENT_QUERIES,
+                  known_messages=frozenset(), slice_plan=None):
+    """
+    并发执行多个时间窗口的 DQL 查询，所有窗口同时提交并各自轮询，
+    总耗时接近最慢的单个查询
+
+    Args:
+        windows: 列表，元素为 (date_str, start_time_str, end_time_str)
+        output_dir: 查询结果文件的保存目录
+        max_workers: 同时进行的查询数上限，为 1 时退化为顺序执行
+        known_messages: FETCH_MODE 为 "two_phase" 时用于判断新消息
+        slice_plan: FETCH_MODE 为 "full" 时使用的 SlicePlan，为 None 时不拆分时间片
+
+    Returns:
+        dict: {date_str: 结果文件名}，失败的日期对应 None
+    """
+    results = {}
+    if not windows:
+        return results
+
+    if FETCH_MODE == "two_phase":
+        fetch = functools.partial(make_two_phase_request, known_messages=known_messages)
+    else:
+        fetch = functools.partial(make_request, slice_plan=slice_plan)
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="dql") as executor:
+        futures = {
+            executor.submit(fetch, client, query, start_time_str, end_time_str,
+                            date_str.replace('-', ''), output_dir): date_str
+            for date_str, start_time_str, end_time_str in windows
+        }
+        for future in as_completed(futures):
+            date_str = futures[future]
+            try:
+                results[date_str] = future.result()
+            except Exception:
+                logging.error(f"获取 {date_str} 的数据时出现未处理的异常：{traceback.format_exc()}")
+                results[date_str] = None
+    return results
+
+
+def iter_json_records(filename, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    增量解析 JSON 数组文件，逐条产出记录，内存占用只与单条记录大小和 chunk_size 有关
+
+    Args:
+        filename: JSON 文件名，内容为记录数组
+        chunk_size: 每次读取的字符数
+
+    Yields:
+        dict: 一条记录
+    """
+    decoder = json.JSONDecoder()
+    with open(filename, 'r', encoding='utf-8') as f:
+        # 开头的空白可能比 chunk_size 长，读到第一个非空白字符或文件末尾为止
+        buffer = f.read(chunk_size)
+        while buffer and not buffer.strip():
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            buffer = chunk
+        pos = _JSON_SEPARATOR.match(buffer).end()
+        if pos >= len(buffer) or buffer[pos] != '[':
+            if not buffer.strip():
+                return
+            raise ValueError(f"{filename} 不是 JSON 数组")
+        pos += 1
+        eof = False
+
+        while True:
+            pos = _JSON_SEPARATOR.match(buffer, pos).end()
+            if pos < len(buffer) and buffer[pos] == ']':
+                return
+            try:
+                record, end = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                end = None
+            # 解析成功且后面还有内容，或者已经读到文件末尾，才能确认记录是完整的
+            if end is not None and (end < len(buffer) or eof):
+                yield record
+                pos = end
+                continue
+            if eof:
+                raise ValueError(f"{filename} 不完整，JSON 数组没有正常结束")
+
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[pos:] + chunk
+            pos = 0
+
+
+def write_json_records(records, filename):
+    """
+    边遍历边把记录写入 JSON 数组文件，并原样产出记录，用于在聚合的同时生成合并文件
+
+    Yields:
+        dict: 一条记录
+    """
+    with open(filename, 'w', encoding='utf-8') as f:
+        f.write('[')
+        for index, record in enumerate(records):
+            f.write(',\n    ' if index else '\n    ')
+            json.dump(record, f)
+            yield record
+        f.write('\n]\n')
+
+
+def write_columnar_records(records, filename):
+    """
+    将记录写成字典编码的列式二进制文件
+
+    文件结构：魔数 | 头部长度 | JSON 头部 | zlib 压缩的值表 | 4 字节对齐填充 | 各列的 uint32 值编号数组。
+    每个不同的值（JSON 编码后）只在值表中保存一次，重复的异常消息和堆栈跟踪只占 4 字节；
+    编号 0 表示该记录没有这一列。列数组不压缩，读取时可以直接内存映射。
+    """
+    value_ids = {}
+    columns = {}
+    row_count = 0
+    for record in records:
+        for key, value in record.items():
+            column = columns.get(key)
+            if column is None:
+                column = columns[key] = array('I', bytes(4 * row_count))
+            encoded = json.dumps(value, ensure_ascii=False)
+            value_id = value_ids.get(encoded)
+            if value_id is None:
+                value_id = value_ids[encoded] = len(value_ids) + 1
+            column.append(value_id)
+        row_count += 1
+        for column in columns.values():
+            if len(column) < row_count:
+                column.append(0)
+
+    # json.dumps 会转义换行，所以可以用换行分隔值表
+    values_blob = zlib.compress("\n".join(value_ids).encode("utf-8"))
+    header = json.dumps({
+        "version": 1,
+        "byteorder": sys.byteorder,
+        "row_count": row_count,
+        "value_count": len(value_ids),
+        "columns": list(columns),
+        "values_length": len(values_blob),
+    }).encode("utf-8")
+
+    with open(filename, 'wb') as f:
+        f.write(COLUMNAR_MAGIC)
+        f.write(_COLUMNAR_HEADER_LENGTH.pack(len(header)))
+        f.write(header)
+        f.write(values_blob)
+        f.write(b"\0" * (-f.tell() % 4))
+        for column in columns.values():
+            column.tofile(f)
+
+
+def iter_columnar_records(filename):
+    """
+    内存映射读取 write_columnar_records 写出的列式文件，逐条产出记录
+
+    相同的值在所有记录间共享同一个 Python 对象，异常消息和堆栈跟踪不会重复占用内存。
+
+    Yields:
+        dict: 一条记录
+    """
+    with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if mm[:len(COLUMNAR_MAGIC)] != COLUMNAR_MAGIC:
+            raise ValueError(f"{filename} 不是列式数据文件")
+        offset = len(COLUMNAR_MAGIC)
+        (header_length,) = _COLUMNAR_HEADER_LENGTH.unpack_from(mm, offset)
+        offset += _COLUMNAR_HEADER_LENGTH.size
+        header = json.loads(mm[offset:offset + header_length])
+        offset += header_length
+
+        values = [None]
+        if header["value_count"]:
+            values_blob = zlib.decompress(mm[offset:offset + header["values_length"]])
+            values.extend(json.loads(value) for value in values_blob.decode("utf-8").split("\n"))
+        offset += header["values_length"]
+        offset += -offset % 4
+
+        row_count = header["row_count"]
+        buffer = memoryview(mm)
+        columns = []
+        try:
+            for _ in header["columns"]:
+                column = buffer[offset:offset + 4 * row_count].cast('I')
+                if header["byteorder"] != sys.byteorder:
+                    column = array('I', column)
+                    column.byteswap()
+                columns.append(column)
+                offset += 4 * row_count
+
+            names = header["columns"]
+            for row in range(row_count):
+                yield {name: values[column[row]] for name, column in zip(names, columns) if column[row]}
+        finally:
+            # 必须先释放所有内存视图，mmap 才能关闭
+            for column in columns:
+                if isinstance(column, memoryview):
+                    column.release()
+            buffer.release()
+
+
+def day_filename(output_dir, day_num, file_format=None):
+    """返回数据集目录中第 day_num 天查询结果的文件名，默认使用 DAY_FILE_FORMAT 格式。"""
+    return f"{output_dir}/dql_result_for_day_{day_num}{DAY_FILE_SUFFIXES[file_format or DAY_FILE_FORMAT]}"
+
+
+def find_day_file(output_dir, day_num):
+    """查找第 day_num 天的结果文件，优先使用当前格式，兼容旧版本运行生成的其他格式文件。"""
+    formats = [DAY_FILE_FORMAT] + [file_format for file_format in DAY_FILE_SUFFIXES if file_format != DAY_FILE_FORMAT]
+    for file_format in formats:
+        filename = day_filename(output_dir, day_num, file_format)
+        if os.path.exists(filename):
+            return filename
+    raise FileNotFoundError(day_filename(output_dir, day_num))
+
+
+def write_day_records(records, filename):
+    """按文件扩展名以对应格式写出一天的查询结果。"""
+    with run_metrics.stage("day_file.write"):
+        if filename.endswith(DAY_FILE_SUFFIXES["columnar"]):
+            write_columnar_records(records, filename)
+        else:
+            with open(filename, 'w', encoding='utf-8') as f:
+                json.dump(records, f)
+
+
+def iter_day_records(filename):
+    """按文件扩展名逐条读取一天的查询结果。"""
+    if filename.endswith(DAY_FILE_SUFFIXES["columnar"]):
+        return iter_columnar_records(filename)
+    return iter_json_records(filename)
 
-    # 上一个工作日往前推7天的数据
-    records_previous_7_days = []
-    for day in range(1, 8):
-        with open(f"{PREVIOUS_WORKDAY_OUTPUT_DIR}/dql_result_for_day_{day}.json", 'r') as f:
-            day_records = json.load(f)
-            records_previous_7_days.extend(day_records)
-    output_filename_previous = f"{OUTPUT_DIR}/merged_previous_workday_7_days.json"
-    with open(output_filename_previous, 'w') as f:
-        json.dump(records_previous_7_days, f, indent=4)
-    logging.info(f"已合并上一个工作日往前推7天的数据到 {output_filename_previous}")
-
-    # 今天往前推1天的数据（最新的1天）
-    records_current_1_day = []
-    with open(f"{OUTPUT_DIR}/dql_result_for_day_7.json", 'r') as f:
-        records_current_1_day = json.load(f)
-
-    # 上一个工作日往前推1天的数据（上一个工作日的最新1天）
-    records_previous_1_day = []
-    with open(f"{PREVIOUS_WORKDAY_OUTPUT_DIR}/dql_result_for_day_7.json", 'r') as f:
-        records_previous_1_day = json.load(f)
+
+def iter_dataset_records(output_dir, days=range(1, 8)):
+    """按天顺序逐条读取数据集目录中的 dql_result_for_day_{n} 文件。"""
+    for day in days:
+        yield from iter_day_records(find_day_file(output_dir, day))
+
+
+def aggregate_output_dirs(current_dir, previous_dir, merged_dir=None):
+    """
+    流式聚合当前和上一个工作日两个数据集目录，不在内存中保留合并后的记录列表
+
+    Args:
+        current_dir: 今天往前推7天的数据集目录
+        previous_dir: 上一个工作日往前推7天的数据集目录
+        merged_dir: 不为 None 时，在聚合的同时把两个7天数据集的合并文件写到该目录
+
+    Returns:
+        dict: {message: 累加器}
+    """
+    records_current_7_days = iter_dataset_records(current_dir)
+    records_previous_7_days = iter_dataset_records(previous_dir)
+    if merged_dir is not None:
+        records_current_7_days = write_json_records(
+            records_current_7_days, f"{merged_dir}/merged_current_7_days.json")
+        records_previous_7_days = write_json_records(
+            records_previous_7_days, f"{merged_dir}/merged_previous_workday_7_days.json")
 
     # 处理数据：按 span.events.exception.message 分组，合并唯一的应用和堆栈跟踪值，求和 count()
-    result = {}
-    all_records = records_current_7_days + records_previous_7_days
-    for record in all_records:
-        app = record.get("app", "Unknown App")
-        message = record.get("span.events.exception.message", "No Exception Message") or ""
-        stacktrace = record.get("span.events.exception.stack_trace", "No Exception Stacktrace") or ""
+    # 每个数据集只遍历一遍，1天数据集只累加已在7天数据集中出现过的消息
+    return aggregate_datasets([
+        (records_current_7_days, "current_7_days_count", True),
+        (records_previous_7_days, "previous_workday_7_days_count", True),
+        # 今天往前推1天的数据（最新的1天）
+        (iter_dataset_records(current_dir, days=[7]), "last_1_day_count", False),
+        # 上一个工作日往前推1天的数据（上一个工作日的最新1天）
+        (iter_dataset_records(previous_dir, days=[7]), "pre_last_1_day_count", False),
+    ])
+
+
+def handle_data(context=None):
+    context = context or get_run_context()
+    with run_metrics.stage("aggregate"):
+        if INCREMENTAL_AGGREGATION and not WRITE_MERGED_FILES:
+            # 聚合：基于每天的快照滑动计算两个7天窗口
+            result = aggregate_incremental(context.output_dir, context.previous_workday_output_dir)
+        else:
+            # 聚合：流式读取今天和上一个工作日往前推7天的数据
+            merged_dir = context.output_dir if WRITE_MERGED_FILES else None
+            result = aggregate_output_dirs(context.output_dir, context.previous_workday_output_dir, merged_dir)
+            if merged_dir is not None:
+                logging.info(f"已合并今天和上一个工作日往前推7天的数据到 {merged_dir}")
+    run_metrics.count("aggregate.messages", len(result))
+
+    sorted_result = categorize_result(result)
+    # 逐行写出报表：先写 summary 工作表，同时按指纹收集堆栈跟踪，再写 stacktraces 工作表
+    stacktrace_rows = {}
+    with run_metrics.stage("report"):
+        filenames = write_report(f"{context.output_dir}/summary", [
+            ("summary", SUMMARY_COLUMNS, iter_summary_rows(sorted_result, stacktrace_rows)),
+            ("stacktraces", STACKTRACE_COLUMNS, iter_stacktrace_rows(stacktrace_rows)),
+        ])
+    logging.info(f"处理完成，结果已保存到 {', '.join(filenames)}")
+    logging.info(f"对比数据说明：")
+    logging.info(f"  - 当前7天数据：{context.today.strftime('%Y-%m-%d')} 往前推7天")
+    logging.info(f"  - 上一个工作日7天数据：{context.previous_workday.strftime('%Y-%m-%d')} 往前推7天")
 
-        if message == "":
-            logging.warning("发现空异常消息，记录：%s", record)
-            break
 
-        if message not in result:
-            result[message] = {
-                "apps": set(),
-                "stacktraces": set(),
-                "current_7_days_count": 0,
-                "previous_workday_7_days_count": 0,
-                "last_1_day_count": 0,
-                "pre_last_1_day_count": 0,
-            }
+def categorize_result(result):
+    """
+    按分类合并聚合结果
 
-        result[message]["apps"].add(app)
-        result[message]["stacktraces"].add(stacktrace)
+    Args:
+        result: {原始消息: 累加器}
 
-    # 计算数量
-    # 今天往前推7天的数据
-    for message in result.keys():
-        for record in records_current_7_days:
-            record_message = record.get("span.events.exception.message", "No Exception Message") or ""
-            if record_message == message:
-                result[message]["current_7_days_count"] += int(record.get("count()", 0))
-
-        # 上一个工作日往前推7天的数据
-        for record in records_previous_7_days:
-            record_message = record.get("span.events.exception.message", "No Exception Message") or ""
-            if record_message == message:
-                result[message]["previous_workday_7_days_count"] += int(record.get("count()", 0))
-
-        # 今天往前推1天的数据
-        for record in records_current_1_day:
-            record_message = record.get("span.events.exception.message", "No Exception Message") or ""
-            if record_message == message:
-                result[message]["last_1_day_count"] += int(record.get("count()", 0))
-
-        # 上一个工作日往前推1天的数据
-        for record in records_previous_1_day:
-            record_message = record.get("span.events.exception.message", "No Exception Message") or ""
-            if record_message == message:
-                result[message]["pre_last_1_day_count"] += int(record.get("count()", 0))
-
-    # 聚合消息分类
+    Returns:
+        list: 按近7天数量降序排列的 (分类, 累加器) 列表，累加器中的 raw_messages 为归入该分类的原始消息
+    """
+    # 聚合消息分类：FUZZY_RULES 优先，未命中规则的消息按自动挖掘出的模板归类
+    with run_metrics.stage("categorize"):
+        categories = categorize_messages(result.keys())
     categorized_result = {}
     for message, details in result.items():
-        new_message = apply_fuzzy_rules(message)
+        new_message = categories[message]
         if new_message not in categorized_result:
-            categorized_result[new_message] = {
-                "apps": set(),
-                "stacktraces": set(),
-                "raw_messages": set(),
-                "current_7_days_count": 0,
-                "previous_workday_7_days_count": 0,
-                "last_1_day_count": 0,
-                "pre_last_1_day_count": 0,
-            }
+            categorized_result[new_message] = new_accumulator()
+            categorized_result[new_message]["raw_messages"] = set()
 
         categorized_result[new_message]["raw_messages"].add(message)
-        categorized_result[new_message]["apps"].update(details["apps"])
-        categorized_result[new_message]["stacktraces"].update(details["stacktraces"])
-        categorized_result[new_message]["current_7_days_count"] += details["current_7_days_count"]
-        categorized_result[new_message]["previous_workday_7_days_count"] += details["previous_workday_7_days_count"]
-        categorized_result[new_message]["last_1_day_count"] += details["last_1_day_count"]
-        categorized_result[new_message]["pre_last_1_day_count"] += details["pre_last_1_day_count"]
+        merge_accumulator(categorized_result[new_message], details)
     result = categorized_result
     logging.info(f"分类后，有 {len(result)} 种异常消息类型。")
+    run_metrics.count("categorize.categories", len(result))
+    fuzzy_rule_engine.log_stats()
+    fuzzy_rule_engine.record_metrics(run_metrics)
 
     # 将结果转换为列表并排序
-    sorted_result = sorted(result.items(), key=lambda x: x[1]["current_7_days_count"], reverse=True)
-    # 输出到 Excel 文件
-    output_data = []
+    return sorted(result.items(), key=lambda x: x[1]["current_7_days_count"], reverse=True)
+
+
+# summary 工作表的列
+SUMMARY_COLUMNS = [
+    "app",
+    "exception message(exp)",
+    "raw messages",
+    "exception stacktrace",
+    "quantity for the last 7 days",
+    "quantity for the previous day",
+    "is_new",
+]
+# stacktraces 工作表的列
+STACKTRACE_COLUMNS = [
+    "fingerprint",
+    "quantity for the last 7 days",
+    "exception messages(exp)",
+    "exception stacktrace",
+]
+
+
+def iter_summary_rows(sorted_result, stacktrace_rows):
+    """
+    逐行生成 summary 工作表，每行是与 SUMMARY_COLUMNS 对应的值列表
+
+    Args:
+        sorted_result: 按近7天数量降序排列的 (异常模式, 累加器) 列表
+        stacktrace_rows: 用于收集 stacktraces 工作表的字典，按指纹累加数量和相关的异常模式
+    """
     for message, details in sorted_result:
-        # 考虑异常堆栈跟踪的 None/空值
-        if not details["stacktraces"]:
-            details["stacktraces"] = {""}
         if not details["raw_messages"]:
             details["raw_messages"] = {""}
         # 将 None 替换为字符串 ""
         details["apps"] = {app if app is not None else "" for app in details["apps"]}
-        details["stacktraces"] = {st if st is not None else "" for st in details["stacktraces"]}
         details["raw_messages"] = {rm if rm is not None else "" for rm in details["raw_messages"]}
+        display_message = message.replace(".*", "******").strip()
+
+        # 按指纹汇总堆栈跟踪，完整文本单独写到 stacktraces 工作表
+        stacktrace_groups = collect_stacktrace_groups(stacktrace_rows, display_message, details["stacktraces"])
 
         # 判断是否为新异常：如果当前7天有出现，但上一个工作日往前7天没有出现
-        if details["current_7_days_count"] > 0 and details["previous_workday_7_days_count"] == 0:
-            details["is_new"] = True
+        is_new = details["current_7_days_count"] > 0 and details["previous_workday_7_days_count"] == 0
+
+        yield [
+            ", ".join(details["apps"]),
+            display_message,
+            "\n\n".join(details["raw_messages"]).strip(),
+            format_stacktrace_groups(stacktrace_groups),
+            f"{details['current_7_days_count']}\nprev: {details['previous_workday_7_days_count']}",
+            f"{details['last_1_day_count']}\nprev: {details['pre_last_1_day_count']}",
+            "YES" if is_new else "",
+        ]
+
+
+def collect_stacktrace_groups(stacktrace_rows, display_message, stacktrace_counts):
+    """
+    按指纹汇总一个异常模式的堆栈跟踪，同时把每个指纹的数量和异常模式累加到 stacktrace_rows 中
+
+    Returns:
+        list: stacktrace_table.summarize 的结果
+    """
+    stacktrace_groups = stacktrace_table.summarize(stacktrace_counts)
+    for group in stacktrace_groups:
+        row = stacktrace_rows.get(group["fingerprint"])
+        if row is None:
+            row = stacktrace_rows[group["fingerprint"]] = {
+                "count": 0,
+                "messages": set(),
+                "stacktrace": group["stacktrace"].strip(),
+            }
+        row["count"] += group["count"]
+        row["messages"].add(display_message)
+    return stacktrace_groups
+
+
+def iter_stacktrace_rows(stacktrace_rows):
+    """按近7天数量降序逐行生成 stacktraces 工作表，需要在 summary 工作表写完后再遍历。"""
+    for fingerprint, row in sorted(stacktrace_rows.items(), key=lambda item: item[1]["count"], reverse=True):
+        yield [fingerprint, row["count"], "\n\n".join(sorted(row["messages"])), row["stacktrace"]]
+
+
+def format_stacktrace_groups(stacktrace_groups):
+    """
+    生成报表中的堆栈跟踪单元格
+
+    每个指纹一段：指纹、近7天数量、变体数，以及数量最多的堆栈跟踪的前几行，
+    完整文本可以按指纹在 stacktraces 工作表中查找。
+    """
+    sections = []
+    for group in stacktrace_groups:
+        lines = group["stacktrace"].strip().splitlines()
+        preview = "\n".join(lines[:STACKTRACE_PREVIEW_LINES])
+        if len(lines) > STACKTRACE_PREVIEW_LINES:
+            preview += f"\n... 共 {len(lines)} 行"
+        header = f"[{group['fingerprint']}] x{group['count']}"
+        if group["variants"] > 1:
+            header += f"，{group['variants']} 种变体"
+        sections.append(f"{header}\n{preview}".strip())
+    return "\n\n".join(sections)
+
+
+class ReportWriter(ABC):
+    """
+    报表写出器的基类
+
+    报表由若干工作表组成：每个工作表先调用 add_sheet 给出列名，再逐行调用 append。
+    写出器不保留已经写出的行，内存占用与行数无关。
+    """
+
+    def __init__(self, basename):
+        """
+        Args:
+            basename: 不带扩展名的报表文件名，例如 output/20251014/summary
+        """
+        self.basename = basename
+        self.filenames = []
+
+    def sheet_filename(self, name, suffix):
+        """每个工作表单独成文件的格式：第一个工作表使用 basename，其余的加上工作表名。"""
+        filename = f"{self.basename}{suffix}" if not self.filenames else f"{self.basename}_{name}{suffix}"
+        self.filenames.append(filename)
+        return filename
+
+    @abstractmethod
+    def add_sheet(self, name, columns):
+        """开始一个新的工作表，columns 为列名列表。"""
+
+    @abstractmethod
+    def append(self, values):
+        """在当前工作表中追加一行，values 与列名一一对应。"""
+
+    def close(self):
+        """写完所有工作表后调用，默认什么也不做。"""
+
+
+class XlsxReportWriter(ReportWriter):
+    """
+    使用 openpyxl 只写模式逐行写出 xlsx
+
+    超过 Excel 单元格上限（EXCEL_CELL_MAX_CHARS）的文本在单元格中截断，
+    完整内容写到报表旁边 REPORT_OVERFLOW_DIR 目录下以单元格坐标命名的文本文件中。
+    """
+
+    def __init__(self, basename):
+        import openpyxl
+        from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+        from openpyxl.utils import get_column_letter
+
+        super().__init__(basename)
+        self.illegal_characters = ILLEGAL_CHARACTERS_RE
+        self.get_column_letter = get_column_letter
+        self.filename = f"{basename}.xlsx"
+        self.filenames.append(self.filename)
+        self.workbook = openpyxl.Workbook(write_only=True)
+        self.sheet = None
+        self.sheet_name = None
+        self.row_number = 0
+        self.overflow_cells = 0
+
+    def add_sheet(self, name, columns):
+        self.sheet = self.workbook.create_sheet(title=name)
+        self.sheet_name = name
+        self.sheet.append(columns)
+        self.row_number = 1
+
+    def append(self, values):
+        self.row_number += 1
+        self.sheet.append([self._cell_value(value, column) for column, value in enumerate(values, start=1)])
+
+    def _cell_value(self, value, column):
+        if not isinstance(value, str):
+            return value
+        # Excel 不允许的控制字符会导致 openpyxl 抛出异常
+        value = self.illegal_characters.sub("", value)
+        if len(value) <= EXCEL_CELL_MAX_CHARS:
+            return value
+
+        cell = f"{self.get_column_letter(column)}{self.row_number}"
+        overflow_filename = f"{REPORT_OVERFLOW_DIR}/{self.sheet_name}_{cell}.txt"
+        overflow_path = os.path.join(os.path.dirname(self.filename), overflow_filename)
+        os.makedirs(os.path.dirname(overflow_path), exist_ok=True)
+        with open(overflow_path, 'w', encoding='utf-8') as f:
+            f.write(value)
+        self.overflow_cells += 1
+
+        note = f"\n... 已截断，共 {len(value)} 个字符，完整内容见 {overflow_filename}"
+        return value[:EXCEL_CELL_MAX_CHARS - len(note)] + note
+
+    def close(self):
+        self.workbook.save(self.filename)
+        if self.overflow_cells:
+            logging.warning(f"{self.overflow_cells} 个单元格超过 Excel 的 {EXCEL_CELL_MAX_CHARS} 字符上限，"
+                            f"已截断，完整内容保存在 {os.path.dirname(self.filename)}/{REPORT_OVERFLOW_DIR}")
+
+
+class CsvReportWriter(ReportWriter):
+    """每个工作表写出一个 CSV 文件，使用带 BOM 的 UTF-8 以便 Excel 直接打开。"""
+
+    def __init__(self, basename):
+        super().__init__(basename)
+        self.file = None
+        self.writer = None
+
+    def add_sheet(self, name, columns):
+        self.close()
+        self.file = open(self.sheet_filename(name, ".csv"), 'w', encoding='utf-8-sig', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(columns)
+
+    def append(self, values):
+        self.writer.writerow(values)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class HtmlReportWriter(ReportWriter):
+    """把所有工作表写成同一个 HTML 文件中的表格，可以直接贴到会议材料中。"""
+
+    def __init__(self, basename):
+        super().__init__(basename)
+        self.filename = f"{basename}.html"
+        self.filenames.append(self.filename)
+        self.file = open(self.filename, 'w', encoding='utf-8')
+        self.file.write(
+            "<!DOCTYPE html>\n<html>\n<head>\n<meta charset=\"utf-8\">\n"
+            f"<title>{html.escape(os.path.basename(basename))}</title>\n"
+            "<style>table{border-collapse:collapse}th,td{border:1px solid #ccc;padding:4px;"
+            "vertical-align:top;white-space:pre-wrap;font-family:monospace;font-size:12px}</style>\n"
+            "</head>\n<body>\n"
+        )
+        self.in_table = False
+
+    def add_sheet(self, name, columns):
+        self._end_table()
+        self.file.write(f"<h2>{html.escape(name)}</h2>\n<table>\n<tr>")
+        self.file.write("".join(f"<th>{html.escape(str(column))}</th>" for column in columns))
+        self.file.write("</tr>\n")
+        self.in_table = True
+
+    def append(self, values):
+        self.file.write("<tr>")
+        self.file.write("".join(f"<td>{html.escape(str(value))}</td>" for value in values))
+        self.file.write("</tr>\n")
+
+    def _end_table(self):
+        if self.in_table:
+            self.file.write("</table>\n")
+            self.in_table = False
+
+    def close(self):
+        self._end_table()
+        self.file.write("</body>\n</html>\n")
+        self.file.close()
+
+
+class ParquetReportWriter(ReportWriter):
+    """每个工作表写出一个 Parquet 文件，按 PARQUET_BATCH_ROWS 行一批写出；需要安装 pyarrow。"""
+
+    def __init__(self, basename):
+        super().__init__(basename)
+        # 可选依赖，只在输出 Parquet 时导入
+        import pyarrow
+        import pyarrow.parquet
+        self.pyarrow = pyarrow
+        self.writer = None
+        self.filename = None
+        self.columns = None
+        self.batch = []
+
+    def add_sheet(self, name, columns):
+        self.close()
+        self.filename = self.sheet_filename(name, ".parquet")
+        self.columns = columns
+        self.batch = []
+
+    def append(self, values):
+        self.batch.append(values)
+        if len(self.batch) >= PARQUET_BATCH_ROWS:
+            self._flush()
+
+    def _flush(self):
+        if self.writer is None:
+            if self.batch:
+                table = self.pyarrow.Table.from_pylist([dict(zip(self.columns, values)) for values in self.batch])
+            else:
+                # 空工作表也写出只有列名的文件
+                table = self.pyarrow.table({column: self.pyarrow.array([], self.pyarrow.string())
+                                            for column in self.columns})
+            self.writer = self.pyarrow.parquet.ParquetWriter(self.filename, table.schema)
         else:
-            details["is_new"] = False
-
-        output_data.append({
-            "app": ", ".join(details["apps"]),
-            "exception message(exp)": message.replace(".*", "******").strip(),
-            "raw messages": "\n\n".join(details["raw_messages"]).strip(),
-            "exception stacktrace": "\n\n".join(details["stacktraces"]).strip(),
-            "quantity for the last 7 days": str(details["current_7_days_count"]) + "\n" +
-                                            f"prev: {str(details['previous_workday_7_days_count'])}",
-            "quantity for the previous day": str(details.get("last_1_day_count", 0)) + "\n" +
-                                             f"prev: {str(details['pre_last_1_day_count'])}",
-            "is_new": "YES" if details.get("is_new") else ""
-        })
-    df = pd.DataFrame(output_data)
-    excel_filename = f"{OUTPUT_DIR}/summary.xlsx"
-    df.to_excel(excel_filename, index=False)
-    logging.info(f"处理完成，结果已保存到 {excel_filename}")
-    logging.info(f"对比数据说明：")
-    logging.info(f"  - 当前7天数据：{today.strftime('%Y-%m-%d')} 往前推7天")
-    logging.info(f"  - 上一个工作日7天数据：{previous_workday.strftime('%Y-%m-%d')} 往前推7天")
+            table = self.pyarrow.Table.from_pylist([dict(zip(self.columns, values)) for values in self.batch],
+                                                   schema=self.writer.schema)
+        self.writer.write_table(table)
+        self.batch = []
+
+    def close(self):
+        if self.filename is None:
+            return
+        if self.batch or self.writer is None:
+            self._flush()
+        self.writer.close()
+        self.writer = None
+        self.filename = None
+
+
+# 报表格式与写出器的对应关系
+REPORT_WRITERS = {
+    "xlsx": XlsxReportWriter,
+    "csv": CsvReportWriter,
+    "html": HtmlReportWriter,
+    "parquet": ParquetReportWriter,
+}
+
+
+def write_report(basename, sheets, formats=None):
+    """
+    逐行把报表同时写出为多种格式
+
+    Args:
+        basename: 不带扩展名的报表文件名
+        sheets: 列表，元素为 (工作表名, 列名列表, 行迭代器)；每个行迭代器只遍历一次，
+                遍历到下一个工作表时才开始，所以后面的工作表可以依赖前面工作表遍历时收集的数据
+        formats: 输出格式列表，默认为 REPORT_FORMATS
+
+    Returns:
+        list: 写出的文件名列表
+    """
+    writers = []
+    for report_format in formats or REPORT_FORMATS:
+        writer_class = REPORT_WRITERS.get(report_format)
+        if writer_class is None:
+            logging.error(f"不支持的报表格式 {report_format}，可选：{', '.join(REPORT_WRITERS)}")
+            continue
+        try:
+            writers.append(writer_class(basename))
+        except ImportError as e:
+            logging.error(f"无法输出 {report_format} 格式的报表，缺少依赖：{e}")
+    if not writers:
+        raise RuntimeError(f"没有可用的报表格式：{formats or REPORT_FORMATS}")
+
+    for name, columns, rows in sheets:
+        for writer in writers:
+            writer.add_sheet(name, columns)
+        for values in rows:
+            for writer in writers:
+                writer.append(values)
+
+    filenames = []
+    for writer in writers:
+        writer.close()
+        filenames.extend(writer.filenames)
+    return filenames
+
+
+# 四个计数器字段，分别对应 handle_data 中的四个数据集
+COUNTER_FIELDS = (
+    "current_7_days_count",
+    "previous_workday_7_days_count",
+    "last_1_day_count",
+    "pre_last_1_day_count",
+)
+
+
+def new_accumulator():
+    """
+    创建单个异常消息的聚合累加器
+
+    stacktraces 为 {堆栈跟踪编号: 数量}，编号来自全局的 stacktrace_table，
+    数量为 STACKTRACE_COUNT_FIELD 对应数据集中的 count() 之和。
+    """
+    accumulator = {
+        "apps": set(),
+        "stacktraces": {},
+    }
+    for field in COUNTER_FIELDS:
+        accumulator[field] = 0
+    return accumulator
+
+
+def merge_accumulator(target, source):
+    """将 source 累加器的应用、堆栈跟踪和计数合并到 target 中。"""
+    target["apps"].update(source["apps"])
+    add_stacktrace_counts(target["stacktraces"], source["stacktraces"].items())
+    for field in COUNTER_FIELDS:
+        target[field] += source[field]
+    return target
+
+
+def accumulate_records(result, records, counter_field, collect_details=True):
+    """
+    单次遍历记录，将 count() 累加到每条消息对应累加器的 counter_field 上
+
+    Args:
+        result: dict，{message: 累加器}，原地更新
+        records: 可迭代的记录
+        counter_field: 要累加的计数器字段，取值见 COUNTER_FIELDS
+        collect_details: 为 True 时新建消息并收集 apps 和 stacktraces；
+                         为 False 时只给已存在的消息计数
+
+    Returns:
+        dict: 更新后的 result
+    """
+    for record in records:
+        message = record.get("span.events.exception.message", "No Exception Message") or ""
+        if message == "":
+            logging.warning("发现空异常消息，记录：%s", record)
+            continue
+
+        accumulator = result.get(message)
+        if accumulator is None:
+            if not collect_details:
+                continue
+            accumulator = result[message] = new_accumulator()
+
+        count = int(record.get("count()", 0))
+        if collect_details:
+            accumulator["apps"].add(record.get("app", "Unknown App"))
+            stacktrace_id = stacktrace_table.intern(
+                record.get("span.events.exception.stack_trace", "No Exception Stacktrace") or "")
+            stacktraces = accumulator["stacktraces"]
+            stacktraces[stacktrace_id] = stacktraces.get(stacktrace_id, 0) + (
+                count if counter_field == STACKTRACE_COUNT_FIELD else 0)
+        accumulator[counter_field] += count
+    return result
+
+
+def add_stacktrace_counts(target, items):
+    """把 (堆栈跟踪编号, 数量) 累加到 target 中。"""
+    for stacktrace_id, count in items:
+        target[stacktrace_id] = target.get(stacktrace_id, 0) + count
+
+
+def normalize_stacktrace(stacktrace):
+    """去掉行号、线程号、对象地址等易变的数字和十六进制串，只保留调用帧的结构。"""
+    frames = []
+    for line in stacktrace.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        for pattern, replacement in STACKTRACE_NORMALIZERS:
+            line = pattern.sub(replacement, line)
+        frames.append(line)
+    return "\n".join(frames)
+
+
+class StacktraceTable:
+    """
+    全局的堆栈跟踪驻留表
+
+    相同的堆栈跟踪文本只保存一份，累加器中只保存整数编号；
+    指纹由规范化后的调用帧计算，只在行号、线程号等细节上不同的堆栈跟踪指纹相同。
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.texts = []
+        self._fingerprints = {}
+        self.lock = threading.Lock()
+
+    def intern(self, stacktrace):
+        stacktrace_id = self.ids.get(stacktrace)
+        if stacktrace_id is None:
+            with self.lock:
+                stacktrace_id = self.ids.get(stacktrace)
+                if stacktrace_id is None:
+                    stacktrace_id = self.ids[stacktrace] = len(self.texts)
+                    self.texts.append(stacktrace)
+        return stacktrace_id
+
+    def text(self, stacktrace_id):
+        return self.texts[stacktrace_id]
+
+    def clear(self):
+        """清空驻留表，之前分配的编号全部失效。"""
+        with self.lock:
+            self.ids = {}
+            self.texts = []
+            self._fingerprints = {}
+
+    def fingerprint(self, stacktrace_id):
+        fingerprint = self._fingerprints.get(stacktrace_id)
+        if fingerprint is None:
+            normalized = normalize_stacktrace(self.texts[stacktrace_id])
+            fingerprint = hashlib.sha1(normalized.encode("utf-8")).hexdigest()[:STACKTRACE_FINGERPRINT_LENGTH]
+            self._fingerprints[stacktrace_id] = fingerprint
+        return fingerprint
+
+    def summarize(self, stacktrace_counts):
+        """
+        按指纹汇总一组堆栈跟踪
+
+        Args:
+            stacktrace_counts: {堆栈跟踪编号: 数量}
+
+        Returns:
+            list: 元素为 {"fingerprint", "count", "variants", "stacktrace"}，按数量降序；
+                  stacktrace 为该指纹下数量最多的原始堆栈跟踪
+        """
+        groups = {}
+        for stacktrace_id, count in stacktrace_counts.items():
+            fingerprint = self.fingerprint(stacktrace_id)
+            group = groups.get(fingerprint)
+            if group is None:
+                group = groups[fingerprint] = {"fingerprint": fingerprint, "count": 0, "variants": 0,
+                                               "top_count": -1, "stacktrace": ""}
+            group["count"] += count
+            group["variants"] += 1
+            if count > group["top_count"]:
+                group["top_count"] = count
+                group["stacktrace"] = self.texts[stacktrace_id]
+        for group in groups.values():
+            del group["top_count"]
+        return sorted(groups.values(), key=lambda group: group["count"], reverse=True)
+
+
+# 全局堆栈跟踪驻留表
+stacktrace_table = StacktraceTable()
+
+
+def aggregate_datasets(datasets):
+    """
+    按消息聚合多个数据集，每个数据集只遍历一次，复杂度为 O(记录总数)
+
+    Args:
+        datasets: 列表，元素为 (records, counter_field, collect_details)，按顺序处理；
+                  collect_details 为 False 的数据集应放在最后
+
+    Returns:
+        dict: {message: 累加器}
+    """
+    result = {}
+    for records, counter_field, collect_details in datasets:
+        accumulate_records(result, records, counter_field, collect_details)
+    return result
+
+
+def build_day_snapshot(records):
+    """
+    单次遍历一天的记录，生成该天的聚合快照
+
+    快照中每条消息保存 count() 之和，以及 app 和堆栈跟踪编号各自出现的记录数（多重集合），
+    这样从窗口中减去某一天时可以准确知道哪些 app 和堆栈跟踪不再出现；堆栈跟踪同时保存 count() 之和。
+
+    Returns:
+        dict: {"version": SNAPSHOT_VERSION,
+               "messages": {message: {"count": 数量, "apps": {app: 记录数}, "stacktraces": {编号: [记录数, 数量]}}},
+               "stacktraces": {编号: 堆栈跟踪}}
+    """
+    messages = {}
+    stacktrace_ids = {}
+    for record in records:
+        message = record.get("span.events.exception.message", "No Exception Message") or ""
+        if message == "":
+            logging.warning("发现空异常消息，记录：%s", record)
+            continue
+
+        entry = messages.get(message)
+        if entry is None:
+            entry = messages[message] = {"count": 0, "apps": {}, "stacktraces": {}}
+        count = int(record.get("count()", 0))
+        entry["count"] += count
+
+        # JSON 的键只能是字符串，None 按报表中的处理方式记为 ""
+        app = record.get("app", "Unknown App")
+        app = "" if app is None else app
+        entry["apps"][app] = entry["apps"].get(app, 0) + 1
+
+        stacktrace = record.get("span.events.exception.stack_trace", "No Exception Stacktrace") or ""
+        stacktrace_id = stacktrace_ids.get(stacktrace)
+        if stacktrace_id is None:
+            stacktrace_id = stacktrace_ids[stacktrace] = hashlib.sha1(stacktrace.encode("utf-8")).hexdigest()[:16]
+        counts = entry["stacktraces"].get(stacktrace_id)
+        if counts is None:
+            counts = entry["stacktraces"][stacktrace_id] = [0, 0]
+        counts[0] += 1
+        counts[1] += count
+
+    return {
+        "version": SNAPSHOT_VERSION,
+        "messages": messages,
+        "stacktraces": {stacktrace_id: stacktrace for stacktrace, stacktrace_id in stacktrace_ids.items()},
+    }
+
+
+def combine_snapshot(state, snapshot, sign):
+    """
+    把一天的快照加到（sign=1）或从（sign=-1）窗口状态中减去，原地更新 state
+
+    app 或堆栈跟踪的记录数减到 0 时移除，消息不再有任何记录时整条移除。
+    """
+    state_messages = state["messages"]
+    for message, entry in snapshot["messages"].items():
+        target = state_messages.get(message)
+        if target is None:
+            target = state_messages[message] = {"count": 0, "apps": {}, "stacktraces": {}}
+        target["count"] += sign * entry["count"]
+        apps = target["apps"]
+        for app, rows in entry["apps"].items():
+            remaining = apps.get(app, 0) + sign * rows
+            if remaining > 0:
+                apps[app] = remaining
+            else:
+                apps.pop(app, None)
+        stacktraces = target["stacktraces"]
+        for stacktrace_id, (rows, count) in entry["stacktraces"].items():
+            current_rows, current_count = stacktraces.get(stacktrace_id, (0, 0))
+            if current_rows + sign * rows > 0:
+                stacktraces[stacktrace_id] = [current_rows + sign * rows, current_count + sign * count]
+            else:
+                stacktraces.pop(stacktrace_id, None)
+        if not apps:
+            del state_messages[message]
+    if sign > 0:
+        state["stacktraces"].update(snapshot["stacktraces"])
+
+
+@contextlib.contextmanager
+def file_lock(filename):
+    """
+    跨进程的排他文件锁
+
+    单次运行、回填和常驻模式可能同时使用同一个 cache/ 目录，修改共享的索引文件时都持有对应的锁，
+    在锁内重新读取索引、修改后写回，不会互相覆盖对方的条目。每次加锁都重新打开锁文件，同一进程的多个线程之间同样互斥。
+    """
+    with open(filename, 'a+') as f:
+        try:
+            import fcntl
+        except ImportError:
+            # Windows 没有 fcntl，改用 msvcrt 锁住锁文件的第一个字节；LK_LOCK 重试 10 秒后仍失败时抛出 OSError
+            import msvcrt
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            return
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class SlidingWindowEngine:
+    """
+    基于每天聚合快照的滑动窗口聚合引擎
+
+    每个结果文件只在第一次出现时完整读取一遍，生成的快照保存在 snapshot_dir 中；
+    7 天窗口的聚合状态保存在 window_dir 中。计算新窗口时找到重叠天数最多的已保存窗口，
+    加上新增的天、减去过期的天，日常运行只需要读取最新一天的原始数据。
+    窗口索引可能被其他进程同时修改，修改时持有 window_dir/.lock 并在锁内重新读取。
+    """
+
+    def __init__(self, snapshot_dir=SNAPSHOT_DIR, window_dir=WINDOW_STATE_DIR, max_windows=MAX_WINDOW_STATES):
+        self.snapshot_dir = snapshot_dir
+        self.window_dir = window_dir
+        self.max_windows = max_windows
+        self.window_index_filename = f"{window_dir}/index.json"
+        self.lock_filename = f"{window_dir}/.lock"
+        os.makedirs(snapshot_dir, exist_ok=True)
+        os.makedirs(window_dir, exist_ok=True)
+        self.window_index = self._load_window_index()
+
+    @staticmethod
+    def identity(filename):
+        """
+        用文件的设备号、inode、大小和修改时间标识一天的数据
+
+        硬链接到同一份缓存文件的两个数据集视图标识相同；缓存文件被重新获取的数据替换后标识随之改变。
+        """
+        stat = os.stat(filename)
+        raw = f"{stat.st_dev}:{stat.st_ino}:{stat.st_size}:{stat.st_mtime_ns}"
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def day_snapshot(self, filename):
+        """读取一天的快照，不存在时遍历结果文件生成并保存。"""
+        identity = self.identity(filename)
+        snapshot = self._load_snapshot(identity)
+        if snapshot is None:
+            snapshot = build_day_snapshot(iter_day_records(filename))
+            self._save_json(f"{self.snapshot_dir}/{identity}.json", snapshot)
+        return snapshot
+
+    def window(self, filenames):
+        """
+        计算多个结果文件组成的窗口的聚合状态
+
+        Returns:
+            dict: 与快照结构相同的窗口状态
+        """
+        identities = [self.identity(filename) for filename in filenames]
+        snapshots = {identity: filename for identity, filename in zip(identities, filenames)}
+        window_id = hashlib.sha1("|".join(identities).encode("utf-8")).hexdigest()
+
+        state = None
+        self.window_index = self._load_window_index()
+        base_id = self._best_base(identities)
+        if base_id is not None:
+            state = self._load_json(f"{self.window_dir}/{base_id}.json")
+        if state is not None:
+            base_days = state["days"]
+            expired = [identity for identity in base_days if identity not in identities]
+            added = [identity for identity in identities if identity not in base_days]
+            expired_snapshots = [self._load_snapshot(identity) for identity in expired]
+            if any(snapshot is None for snapshot in expired_snapshots):
+                logging.warning("过期天的快照缺失，重新计算整个窗口")
+                state = None
+            else:
+                for snapshot in expired_snapshots:
+                    combine_snapshot(state, snapshot, -1)
+                logging.info("滑动窗口：复用已保存的窗口，新增 %d 天，移除 %d 天", len(added), len(expired))
+        if state is None:
+            state = {"version": SNAPSHOT_VERSION, "messages": {}, "stacktraces": {}}
+            added = identities
+
+        for identity in added:
+            combine_snapshot(state, self.day_snapshot(snapshots[identity]), 1)
+
+        state["days"] = identities
+        if base_id != window_id or added:
+            self._save_window(window_id, state)
+        else:
+            with file_lock(self.lock_filename):
+                self.window_index = self._load_window_index()
+                if window_id in self.window_index:
+                    self.window_index[window_id]["saved_at"] = datetime.now().isoformat()
+                    self._save_json(self.window_index_filename, self.window_index)
+        return state
+
+    def _best_base(self, identities):
+        best_id, best_overlap = None, 0
+        for window_id, entry in self.window_index.items():
+            overlap = len(set(entry["days"]) & set(identities))
+            if overlap > best_overlap:
+                best_id, best_overlap = window_id, overlap
+        return best_id
+
+    def _save_window(self, window_id, state):
+        # 只保留仍被引用的堆栈跟踪
+        referenced = set()
+        for entry in state["messages"].values():
+            referenced.update(entry["stacktraces"])
+        state["stacktraces"] = {key: value for key, value in state["stacktraces"].items() if key in referenced}
+        self._save_json(f"{self.window_dir}/{window_id}.json", state)
+        with file_lock(self.lock_filename):
+            self.window_index = self._load_window_index()
+            self.window_index[window_id] = {"days": state["days"], "saved_at": datetime.now().isoformat()}
+
+            # 淘汰最早保存的窗口状态，以及不再被任何窗口引用的快照
+            for stale_id in sorted(self.window_index,
+                                   key=lambda key: self.window_index[key]["saved_at"])[:-self.max_windows]:
+                self.window_index.pop(stale_id)
+                self._remove(f"{self.window_dir}/{stale_id}.json")
+            self._save_json(self.window_index_filename, self.window_index)
+            kept = {identity for entry in self.window_index.values() for identity in entry["days"]}
+            for name in os.listdir(self.snapshot_dir):
+                if name.endswith(".json") and name[:-len(".json")] not in kept:
+                    self._remove(f"{self.snapshot_dir}/{name}")
+
+    def _load_window_index(self):
+        try:
+            with open(self.window_index_filename, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _load_snapshot(self, identity):
+        return self._load_json(f"{self.snapshot_dir}/{identity}.json")
+
+    @staticmethod
+    def _load_json(filename):
+        try:
+            with open(filename, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        # 旧版本格式的快照和窗口状态视为不存在，重新计算
+        return data if data.get("version") == SNAPSHOT_VERSION else None
+
+    @staticmethod
+    def _save_json(filename, data):
+        tmp_filename = f"{filename}.tmp"
+        with open(tmp_filename, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_filename, filename)
+
+    @staticmethod
+    def _remove(filename):
+        try:
+            os.remove(filename)
+        except FileNotFoundError:
+            pass
+
+
+def aggregate_incremental(current_dir, previous_dir, engine=None):
+    """
+    用滑动窗口引擎聚合当前和上一个工作日两个数据集，结果与 aggregate_output_dirs 相同
+
+    Returns:
+        dict: {message: 累加器}
+    """
+    engine = engine or SlidingWindowEngine()
+    windows = []
+    last_days = []
+    datasets = [
+        (current_dir, "current_7_days_count", "last_1_day_count"),
+        (previous_dir, "previous_workday_7_days_count", "pre_last_1_day_count"),
+    ]
+    for output_dir, window_field, last_day_field in datasets:
+        windows.append((engine.window([find_day_file(output_dir, day) for day in range(1, 8)]), window_field))
+        last_days.append((engine.day_snapshot(find_day_file(output_dir, 7)), last_day_field))
+    return aggregate_window_states(windows, last_days)
+
+
+def aggregate_window_states(windows, last_days):
+    """
+    把两个7天窗口的聚合状态转换为 {message: 累加器}
+
+    Args:
+        windows: 列表，元素为 (窗口状态, counter_field)，依次为当前和上一个工作日的7天窗口
+        last_days: 列表，元素为 (快照, counter_field)，两个窗口各自最新1天的快照
+
+    Returns:
+        dict: {message: 累加器}
+    """
+    result = {}
+    for state, counter_field in windows:
+        stacktraces = state["stacktraces"]
+        count_stacktraces = counter_field == STACKTRACE_COUNT_FIELD
+        for message, entry in state["messages"].items():
+            accumulator = result.get(message)
+            if accumulator is None:
+                accumulator = result[message] = new_accumulator()
+            accumulator["apps"].update(entry["apps"])
+            add_stacktrace_counts(accumulator["stacktraces"], (
+                (stacktrace_table.intern(stacktraces[stacktrace_id]), count if count_stacktraces else 0)
+                for stacktrace_id, (_, count) in entry["stacktraces"].items()
+            ))
+            accumulator[counter_field] += entry["count"]
+
+    # 最新1天的数量只累加已在7天数据集中出现过的消息
+    for snapshot, counter_field in last_days:
+        for message, entry in snapshot["messages"].items():
+            if message in result:
+                result[message][counter_field] += entry["count"]
+    return result
+
+
+def literal_prefix(pattern):
+    """
+    提取正则表达式开头的字面量前缀，任何能匹配该规则的消息都必须以这个前缀开头
+
+    Args:
+        pattern: 正则表达式
+
+    Returns:
+        str: 字面量前缀，规则包含分支（|）或以元字符开头时返回空字符串
+    """
+    if "|" in pattern.replace("\\|", ""):
+        return ""
+    prefix = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == "\\":
+            # 只有转义的标点是字面量，\d、\w 等是字符类
+            if i + 1 >= len(pattern) or pattern[i + 1].isalnum():
+                break
+            literal, step = pattern[i + 1], 2
+        elif char in ".^$*+?{}[]()":
+            break
+        else:
+            literal, step = char, 1
+        # 后面跟着量词时该字符可能不出现
+        if pattern[i + step:i + step + 1] in ("*", "+", "?", "{"):
+            break
+        prefix.append(literal)
+        i += step
+    return "".join(prefix)
+
+
+class FuzzyRuleEngine:
+    """
+    预编译并按字面量前缀索引的模糊匹配规则引擎
+
+    规则按字面量前缀的前 FUZZY_RULE_PREFIX_LENGTH 个字符建立索引，
+    每条消息只尝试前缀相符的规则和没有足够长前缀的规则，并保持规则原有的先后顺序；
+    分类结果用有界的 LRU 缓存记忆。每条规则记录命中次数和正则匹配耗时
+    （只统计缓存未命中时的实际匹配）。
+    """
+
+    def __init__(self, rules, cache_size=FUZZY_RULE_CACHE_SIZE):
+        self.rules = list(rules)
+        self.patterns = [re.compile(rule, flags=re.DOTALL) for rule in self.rules]
+        self.prefixes = [literal_prefix(rule) for rule in self.rules]
+        self.hits = [0] * len(self.rules)
+        self.match_seconds = [0.0] * len(self.rules)
+
+        self._indexed = {}
+        self._unindexed = []
+        for index, prefix in enumerate(self.prefixes):
+            if len(prefix) >= FUZZY_RULE_PREFIX_LENGTH:
+                self._indexed.setdefault(prefix[:FUZZY_RULE_PREFIX_LENGTH], []).append(index)
+            else:
+                self._unindexed.append(index)
+
+        if cache_size:
+            self.classify = functools.lru_cache(maxsize=cache_size)(self._classify)
+        else:
+            self.classify = self._classify
+
+    def _candidates(self, text):
+        indexed = self._indexed.get(text[:FUZZY_RULE_PREFIX_LENGTH])
+        if not indexed:
+            return self._unindexed
+        if not self._unindexed:
+            return indexed
+        return heapq.merge(indexed, self._unindexed)
+
+    def _classify(self, message):
+        text = message.strip()
+        for index in self._candidates(text):
+            if not text.startswith(self.prefixes[index]):
+                continue
+            started = time.perf_counter()
+            matched = self.patterns[index].fullmatch(text)
+            self.match_seconds[index] += time.perf_counter() - started
+            if matched:
+                self.hits[index] += 1
+                return self.rules[index]
+        return message
+
+    def stats(self):
+        """
+        返回每条规则的命中次数和匹配耗时，按匹配耗时降序排列
+
+        Returns:
+            list: 元素为 {"rule": 规则, "hits": 命中的不同消息数, "match_seconds": 匹配耗时}
+        """
+        rule_stats = [
+            {"rule": rule, "hits": hits, "match_seconds": seconds}
+            for rule, hits, seconds in zip(self.rules, self.hits, self.match_seconds)
+        ]
+        return sorted(rule_stats, key=lambda item: item["match_seconds"], reverse=True)
+
+    def record_metrics(self, metrics):
+        """把规则匹配耗时和缓存命中情况记录到运行指标中。"""
+        metrics.count("rules.match_seconds", round(sum(self.match_seconds), 3))
+        metrics.count("rules.hits", sum(self.hits))
+        if hasattr(self.classify, "cache_info"):
+            cache_info = self.classify.cache_info()
+            metrics.count("rules.cache_hits", cache_info.hits)
+            metrics.count("rules.cache_misses", cache_info.misses)
+
+    def log_stats(self, top=10):
+        if hasattr(self.classify, "cache_info"):
+            cache_info = self.classify.cache_info()
+            logging.info("模糊规则缓存：命中 %d 次，未命中 %d 次，当前 %d 条",
+                         cache_info.hits, cache_info.misses, cache_info.currsize)
+        for item in self.stats()[:top]:
+            logging.info("模糊规则 %s：命中 %d 条消息，匹配耗时 %.4f 秒",
+                         item["rule"], item["hits"], item["match_seconds"])
+
+
+# 由 FUZZY_RULES 构建的默认规则引擎，运行时修改 FUZZY_RULES 后需要重新构建
+fuzzy_rule_engine = FuzzyRuleEngine(FUZZY_RULES)
 
 
 # 功能：应用模糊匹配规则
 def apply_fuzzy_rules(message):
-    for rule in FUZZY_RULES:
-        if re.fullmatch(rule, message.strip(), flags=re.DOTALL):
-            return rule
-    return message
+    return fuzzy_rule_engine.classify(message)
+
+
+class TemplateMiner:
+    """
+    Drain 风格的日志模板挖掘
+
+    消息先用 TEMPLATE_MASKS 把 ID、十六进制串、IP、主机名和数字替换为通配符，再按空白切分成词元；
+    前缀树第一层按词元个数分组，之后按前 TEMPLATE_PREFIX_TOKENS 个词元逐层分组（含数字或通配符的词元
+    归入通配符分支），叶子节点中选出相似度最高的模板，达到 TEMPLATE_SIMILARITY 时合并，
+    不同的位置变为通配符，否则新建模板。默认的 1.0 只合并屏蔽后完全相同的消息。每条消息只访问一条路径，总耗时与消息数线性相关。
+    """
+
+    def __init__(self, prefix_tokens=TEMPLATE_PREFIX_TOKENS, similarity=TEMPLATE_SIMILARITY,
+                 max_children=TEMPLATE_MAX_CHILDREN):
+        self.prefix_tokens = prefix_tokens
+        self.similarity = similarity
+        self.max_children = max_children
+        self.root = {}
+        # 每个模板是一个词元列表
+        self.templates = []
+
+    @staticmethod
+    def tokenize(message):
+        for pattern in TEMPLATE_MASKS:
+            message = pattern.sub(TEMPLATE_WILDCARD, message)
+        return message.split()
+
+    def add(self, message):
+        """
+        把消息加入前缀树
+
+        Returns:
+            int: 消息所属模板的编号，模板内容可能随后续消息继续泛化
+        """
+        tokens = self.tokenize(message)
+        node = self.root.setdefault(len(tokens), {})
+        for token in tokens[:self.prefix_tokens]:
+            if TEMPLATE_WILDCARD in token or any(char.isdigit() for char in token):
+                token = TEMPLATE_WILDCARD
+            if token not in node and len(node) >= self.max_children:
+                token = TEMPLATE_WILDCARD
+            node = node.setdefault(token, {})
+        leaf = node.setdefault(None, [])
+
+        best_id, best_similarity = None, -1.0
+        for template_id in leaf:
+            similarity = self._similarity(self.templates[template_id], tokens)
+            if similarity > best_similarity:
+                best_id, best_similarity = template_id, similarity
+
+        if best_id is not None and best_similarity >= self.similarity:
+            template = self.templates[best_id]
+            for i, token in enumerate(tokens):
+                if template[i] != token:
+                    template[i] = TEMPLATE_WILDCARD
+            return best_id
+
+        self.templates.append(tokens)
+        leaf.append(len(self.templates) - 1)
+        return len(self.templates) - 1
+
+    @staticmethod
+    def _similarity(template, tokens):
+        if not tokens:
+            return 1.0
+        same = sum(1 for expected, token in zip(template, tokens)
+                   if expected == token or expected == TEMPLATE_WILDCARD)
+        return same / len(tokens)
+
+    def template(self, template_id):
+        """返回模板字符串，通配符以 .* 表示，与 FUZZY_RULES 的写法一致。"""
+        return " ".join(self.templates[template_id]).replace(TEMPLATE_WILDCARD, ".*")
+
+
+def categorize_messages(messages):
+    """
+    为每条原始异常消息确定分类
 
+    命中 FUZZY_RULES 的消息归入对应规则（人工规则优先）；其余消息在 ENABLE_TEMPLATE_MINING 打开时
+    归入自动挖掘出的模板，否则保持原样。
 
-def get_unique_date_ranges():
+    Returns:
+        dict: {原始消息: 分类}
+    """
+    categories = {}
+    unmatched = []
+    for message in messages:
+        category = apply_fuzzy_rules(message)
+        categories[message] = category
+        if category == message:
+            unmatched.append(message)
+
+    if ENABLE_TEMPLATE_MINING and unmatched:
+        miner = TemplateMiner()
+        template_ids = [miner.add(message) for message in unmatched]
+        for message, template_id in zip(unmatched, template_ids):
+            categories[message] = miner.template(template_id)
+        logging.info(f"{len(unmatched)} 条未命中规则的消息归纳为 {len(miner.templates)} 个模板")
+    return categories
+
+
+def get_unique_date_ranges(context=None):
     """
     计算需要获取数据的所有唯一日期，避免重复请求
-    
+
     Returns:
         dict: {date_str: {'date': date_obj, 'needed_for': [('current', day_num), ('previous', day_num)]}}
     """
+    context = context or get_run_context()
     unique_dates = {}
 
     # 今天往前推7天的数据
-    today_start = today - timedelta(days=7)
+    today_start = context.today - timedelta(days=7)
     for i in range(7):
         date_obj = today_start + timedelta(days=i)
         date_str = date_obj.strftime('%Y-%m-%d')
@@ -398,7 +2484,7 @@ def get_unique_date_ranges():
         unique_dates[date_str]['needed_for'].append(('current', i + 1))
 
     # 上一个工作日往前推7天的数据
-    previous_start = previous_workday - timedelta(days=7)
+    previous_start = context.previous_workday - timedelta(days=7)
     for i in range(7):
         date_obj = previous_start + timedelta(days=i)
         date_str = date_obj.strftime('%Y-%m-%d')
@@ -413,34 +2499,936 @@ def get_unique_date_ranges():
     return unique_dates
 
 
-def main():
-    # 设置日志记录
-    log_file = setup_logging()
-    logging.info(f"日志文件：{log_file}")
+def link_day_file(source, target):
+    """
+    让 target 与 source 共享同一份数据：优先使用硬链接，文件系统不支持时退回到复制
 
-    # 从 resources 读取查询、cookie 和 csrftoken
+    不使用符号链接，因为缓存淘汰 source 后符号链接会失效，而硬链接仍然保留数据。
+
+    Returns:
+        str: "hardlink" 或 "copy"
+    """
+    if os.path.lexists(target):
+        os.remove(target)
+    try:
+        os.link(source, target)
+        return "hardlink"
+    except OSError:
+        shutil.copyfile(source, target)
+        return "copy"
+
+
+def write_dataset_manifest(output_dir, days):
+    """
+    写出数据集目录的清单 manifest.json，记录每个 day_num 对应的日期和数据来源
+
+    Args:
+        days: dict，{day_num: {"date": 日期, "source": 缓存文件名或 None, "link": 关联方式}}
+    """
+    manifest = {
+        "generated_at": datetime.now().isoformat(),
+        "format": DAY_FILE_FORMAT,
+        "days": {str(day_num): days[day_num] for day_num in sorted(days)},
+    }
+    with open(f"{output_dir}/manifest.json", 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=4, ensure_ascii=False)
+
+
+class DayCache:
+    """
+    按天缓存 DQL 查询结果的本地内容寻址存储
+
+    缓存键由 (查询语句哈希, 窗口开始时间, 窗口结束时间, 时区) 计算得到，
+    查询语句改动后旧缓存自然失效。索引文件记录每个条目的获取时间、
+    是否完整和最后访问时间，用于判断有效期和淘汰。
+
+    单次运行、回填和常驻模式可能同时使用同一个缓存目录：修改索引时持有 cache_dir/.lock，
+    在锁内重新读取索引再写回；每个进程使用自己的暂存目录，同名的结果文件不会互相覆盖。
+    """
+
+    def __init__(self, cache_dir=DAY_CACHE_DIR, settle_hours=DAY_CACHE_SETTLE_HOURS,
+                 incomplete_ttl_hours=DAY_CACHE_INCOMPLETE_TTL_HOURS,
+                 max_age_days=DAY_CACHE_MAX_AGE_DAYS, max_bytes=DAY_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.index_filename = f"{cache_dir}/index.json"
+        self.lock_filename = f"{cache_dir}/.lock"
+        # 查询结果先写到本进程的暂存目录，成功后再移动到缓存中
+        self.staging_root = f"{cache_dir}/staging"
+        self._staging_dir = f"{self.staging_root}/{os.getpid()}"
+        self.settle = timedelta(hours=settle_hours)
+        self.incomplete_ttl = timedelta(hours=incomplete_ttl_hours)
+        self.max_age = timedelta(days=max_age_days)
+        self.max_bytes = max_bytes
+        os.makedirs(self.staging_root, exist_ok=True)
+        self._remove_stale_staging_dirs()
+        self.index = self._load_index()
+
+    @property
+    def staging_dir(self):
+        """本进程的暂存目录，每次使用时确保存在并更新修改时间。"""
+        os.makedirs(self._staging_dir, exist_ok=True)
+        os.utime(self._staging_dir)
+        return self._staging_dir
+
+    def _remove_stale_staging_dirs(self):
+        """删除其他进程留下的、一天以上没有使用的空暂存目录。"""
+        for name in os.listdir(self.staging_root):
+            path = f"{self.staging_root}/{name}"
+            if path == self._staging_dir or not os.path.isdir(path):
+                continue
+            try:
+                if time.time() - os.path.getmtime(path) > 86400:
+                    os.rmdir(path)
+            except OSError:
+                pass
+
+    @staticmethod
+    def make_key(query, start_time_str, end_time_str, timezone=QUERY_TIMEZONE):
+        query_hash = hashlib.sha256(query.encode("utf-8")).hexdigest()
+        raw_key = "|".join([query_hash, start_time_str, end_time_str, timezone])
+        return hashlib.sha256(raw_key.encode("utf-8")).hexdigest()
+
+    def get_filename(self, query, start_time_str, end_time_str, timezone=QUERY_TIMEZONE):
+        """
+        查找缓存的结果文件，不读取内容
+
+        Returns:
+            str: 命中时返回缓存文件名；未命中、未完整且已过期或文件丢失时返回 None
+        """
+        key = self.make_key(query, start_time_str, end_time_str, timezone)
+        self.index = self._load_index()
+        if key not in self.index:
+            return None
+
+        with file_lock(self.lock_filename):
+            self.index = self._load_index()
+            entry = self.index.get(key)
+            if entry is None:
+                return None
+
+            now = datetime.now()
+            if not entry["complete"] and now - datetime.fromisoformat(entry["fetched_at"]) > self.incomplete_ttl:
+                logging.info("缓存 %s ~ %s 未完整且已过期", start_time_str, end_time_str)
+                return None
+
+            data_filename = self._data_filename(key)
+            if not os.path.exists(data_filename):
+                logging.warning("缓存文件 %s 不存在，将重新查询", data_filename)
+                self.index.pop(key, None)
+                self._save_index()
+                return None
+
+            entry["last_access"] = now.isoformat()
+            self._save_index()
+            return data_filename
+
+    def is_complete(self, query, start_time_str, end_time_str, timezone=QUERY_TIMEZONE):
+        """缓存中是否有该窗口的完整数据（窗口结束 settle_hours 之后获取）。"""
+        self.index = self._load_index()
+        entry = self.index.get(self.make_key(query, start_time_str, end_time_str, timezone))
+        return entry is not None and entry["complete"]
+
+    def put_file(self, query, start_time_str, end_time_str, filename, timezone=QUERY_TIMEZONE):
+        """
+        将查询结果文件移动到缓存中，并根据窗口结束时间判断该天数据是否已完整
+
+        Args:
+            filename: 查询结果文件，应位于 staging_dir 中，格式须与 DAY_FILE_FORMAT 一致
+
+        Returns:
+            str: 缓存文件名
+        """
+        key = self.make_key(query, start_time_str, end_time_str, timezone)
+        now = datetime.now()
+        complete = now - datetime.fromisoformat(end_time_str) >= self.settle
+
+        data_filename = self._data_filename(key)
+        with file_lock(self.lock_filename):
+            self.index = self._load_index()
+            os.replace(filename, data_filename)
+            self.index[key] = {
+                "start": start_time_str,
+                "end": end_time_str,
+                "timezone": timezone,
+                "fetched_at": now.isoformat(),
+                "last_access": now.isoformat(),
+                "complete": complete,
+                "size": os.path.getsize(data_filename),
+            }
+            self._evict()
+        return data_filename
+
+    def evict(self):
+        """淘汰长时间未访问的条目，并在总大小超限时按最近最少使用淘汰。"""
+        with file_lock(self.lock_filename):
+            self.index = self._load_index()
+            self._evict()
+
+    def _evict(self):
+        """在持有锁时淘汰条目，同时删除不在索引中的结果文件（例如加锁之前的版本并发写索引时丢失的条目）。"""
+        now = datetime.now()
+        expired = [key for key, entry in self.index.items()
+                   if now - datetime.fromisoformat(entry["last_access"]) > self.max_age]
+        by_last_access = sorted(
+            (key for key in self.index if key not in expired),
+            key=lambda k: self.index[k]["last_access"],
+        )
+        total_bytes = sum(self.index[key]["size"] for key in by_last_access)
+        while by_last_access and total_bytes > self.max_bytes:
+            key = by_last_access.pop(0)
+            total_bytes -= self.index[key]["size"]
+            expired.append(key)
+
+        for key in expired:
+            self.index.pop(key)
+            try:
+                os.remove(self._data_filename(key))
+            except FileNotFoundError:
+                pass
+        if expired:
+            logging.info("已淘汰 %d 个缓存条目", len(expired))
+
+        suffixes = tuple(DAY_FILE_SUFFIXES.values())
+        orphans = [name for name in os.listdir(self.cache_dir)
+                   if name.endswith(suffixes) and len(name.split(".")[0]) == 64 and name.split(".")[0] not in self.index]
+        for name in orphans:
+            os.remove(f"{self.cache_dir}/{name}")
+        if orphans:
+            logging.info("已删除 %d 个不在索引中的缓存文件", len(orphans))
+        self._save_index()
+
+    def _data_filename(self, key):
+        return f"{self.cache_dir}/{key}{DAY_FILE_SUFFIXES[DAY_FILE_FORMAT]}"
+
+    def _load_index(self):
+        try:
+            with open(self.index_filename, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            logging.warning("缓存索引 %s 损坏，已重建", self.index_filename)
+            return {}
+
+    def _save_index(self):
+        tmp_filename = f"{self.index_filename}.tmp"
+        with open(tmp_filename, 'w') as f:
+            json.dump(self.index, f, indent=4)
+        os.replace(tmp_filename, self.index_filename)
+
+
+def read_query():
+    """读取 resources/query.txt 中的 DQL 查询语句。"""
     with open('resources/query.txt', 'r', encoding='utf-8') as f:
         query = f.read()
-    with open('resources/cookie.txt', 'r', encoding='utf-8') as f:
+    if not query:
+        logging.error("查询为空，请检查 resources/query.txt。")
+    return query
+
+
+def read_credentials(environment=DEFAULT_ENVIRONMENT):
+    """
+    读取环境对应的 cookie 和 csrftoken
+
+    默认环境位于 resources/，其他环境位于 resources/{环境名}/。
+
+    Returns:
+        tuple: (cookie, csrftoken)
+    """
+    resource_dir = "resources" if environment == DEFAULT_ENVIRONMENT else f"resources/{environment}"
+    with open(f'{resource_dir}/cookie.txt', 'r', encoding='utf-8') as f:
         cookie = f.read().strip()
-    with open('resources/csrftoken.txt', 'r', encoding='utf-8') as f:
+    with open(f'{resource_dir}/csrftoken.txt', 'r', encoding='utf-8') as f:
         csrftoken = f.read().strip()
-    if not query or not cookie:
-        logging.error("查询或 cookie 为空，请检查 resources/query.txt 和 resources/cookie.txt。")
+    if not cookie:
+        logging.error(f"cookie 为空，请检查 {resource_dir}/cookie.txt。")
+    return cookie, csrftoken
+
+
+def make_cache_query(query, environment=DEFAULT_ENVIRONMENT):
+    """
+    生成计算缓存键使用的查询语句
+
+    两阶段模式的结果与单阶段不同，不同环境的结果也不能共用，都需要在缓存键中区分；
+    DYNATRACE_BASE_URL 指向其他地址（例如本地替身服务器）时也要区分，避免替身的数据以生产环境的键写入缓存。
+    默认环境的单阶段查询保持原样，以便复用已有的缓存。
+    """
+    cache_query = query
+    if FETCH_MODE != "full":
+        cache_query += f"\n// fetch_mode={FETCH_MODE} top_n={TWO_PHASE_TOP_N} new_max={TWO_PHASE_NEW_MESSAGES_MAX}"
+    if environment != DEFAULT_ENVIRONMENT:
+        cache_query += f"\n// environment={environment}"
+    elif DYNATRACE_BASE_URL != DEFAULT_DYNATRACE_BASE_URL:
+        cache_query += f"\n// base_url={DYNATRACE_BASE_URL}"
+    return cache_query
+
+
+def day_window(date_obj):
+    """一天的查询窗口：当天 10:00:00 到第二天 10:00:00。"""
+    start_time_str = date_obj.strftime("%Y-%m-%dT10:00:00.000")
+    end_time_str = (date_obj + timedelta(days=1)).strftime("%Y-%m-%dT10:00:00.000")
+    return start_time_str, end_time_str
+
+
+def fetch_backfill_days(environment, query, dates, output_dir):
+    """
+    获取一个环境在多天内的结果文件，命中本地缓存的日期不再查询
+
+    每个结果文件放入缓存后立即硬链接到 output_dir，之后即使缓存因容量上限淘汰了早期的条目，
+    回填需要的数据仍然保留。
+
+    Returns:
+        dict: {日期 YYYY-MM-DD: output_dir 中的结果文件名}，获取失败的日期不在其中
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    day_cache = DayCache()
+    cache_query = make_cache_query(query, environment)
+    day_files = {}
+    pending_windows = []
+
+    def link(date_str, source):
+        target = day_filename(output_dir, date_str.replace("-", ""))
+        link_day_file(source, target)
+        day_files[date_str] = target
+
+    for date_obj in dates:
+        date_str = date_obj.strftime('%Y-%m-%d')
+        start_time_str, end_time_str = day_window(date_obj)
+        cached_filename = day_cache.get_filename(cache_query, start_time_str, end_time_str)
+        if cached_filename is not None:
+            link(date_str, cached_filename)
+        else:
+            pending_windows.append((date_str, start_time_str, end_time_str))
+    logging.info(f"环境 {environment}：本地缓存命中 {len(day_files)} 天，需要查询 {len(pending_windows)} 天")
+    run_metrics.count("day_cache.hits", len(day_files))
+    run_metrics.count("day_cache.misses", len(pending_windows))
+    if not pending_windows:
+        return day_files
+
+    cookie, csrftoken = read_credentials(environment)
+    known_messages = collect_known_messages(day_files.values()) if FETCH_MODE == "two_phase" else frozenset()
+    with DynatraceClient(cookie, csrftoken, base_url=DYNATRACE_ENVIRONMENTS[environment]) as client:
+        fetched_files = fetch_windows(client, query, pending_windows, day_cache.staging_dir,
+                                      known_messages=known_messages,
+                                      slice_plan=SlicePlan() if ADAPTIVE_WINDOWS else None)
+
+    for date_str, start_time_str, end_time_str in pending_windows:
+        temp_filename = fetched_files.get(date_str)
+        if temp_filename:
+            link(date_str, day_cache.put_file(cache_query, start_time_str, end_time_str, temp_filename))
+        else:
+            logging.error(f"环境 {environment} {date_str} 的数据获取失败")
+    return day_files
+
+
+def new_backfill_accumulator():
+    """
+    回填模式的累加器
+
+    stacktraces 以堆栈跟踪文本为键（堆栈跟踪编号只在单个进程内有效），
+    counts 为 {(环境, 统计周期): 数量}。
+    """
+    return {
+        "apps": set(),
+        "stacktraces": {},
+        "raw_messages": set(),
+        "counts": {},
+    }
+
+
+def merge_backfill_accumulator(target, source):
+    """把 source 合并到 target 中。"""
+    target["apps"].update(source["apps"])
+    target["raw_messages"].update(source["raw_messages"])
+    for field in ("stacktraces", "counts"):
+        counts = target[field]
+        for key, count in source[field].items():
+            counts[key] = counts.get(key, 0) + count
+
+
+def merge_backfill_partials(target, source):
+    """合并两个部分结果，返回 target。"""
+    for field in ("categories", "messages"):
+        accumulators = target[field]
+        for key, accumulator in source[field].items():
+            existing = accumulators.get(key)
+            if existing is None:
+                accumulators[key] = accumulator
+            else:
+                merge_backfill_accumulator(existing, accumulator)
+    return target
+
+
+def backfill_period(date_str, start_date, period_days):
+    """日期所属统计周期的第一天，周期从 start_date 开始每 period_days 天一个。"""
+    date_obj = datetime.strptime(date_str, '%Y-%m-%d')
+    offset = (date_obj - start_date).days // period_days * period_days
+    return (start_date + timedelta(days=offset)).strftime('%Y-%m-%d')
+
+
+def aggregate_backfill_shard(shard, start_date, period_days):
+    """
+    在子进程中聚合一个分片的结果文件，模糊规则分类也在子进程中完成
+
+    未命中规则的消息需要与所有分片的消息一起挖掘模板，先按原始消息保留，合并后再分类。
+
+    Args:
+        shard: 列表，元素为 (环境, 日期 YYYY-MM-DD, 结果文件名)
+
+    Returns:
+        dict: 可合并的部分结果 {"categories": {规则: 累加器}, "messages": {未命中规则的消息: 累加器}}
+    """
+    partial = {"categories": {}, "messages": {}}
+    for environment, date_str, filename in shard:
+        column = (environment, backfill_period(date_str, start_date, period_days))
+        for record in iter_day_records(filename):
+            message = record.get("span.events.exception.message", "No Exception Message") or ""
+            if message == "":
+                continue
+
+            category = apply_fuzzy_rules(message)
+            if category == message:
+                accumulators = partial["messages"]
+            else:
+                accumulators = partial["categories"]
+            accumulator = accumulators.get(category)
+            if accumulator is None:
+                accumulator = accumulators[category] = new_backfill_accumulator()
+
+            count = int(record.get("count()", 0))
+            accumulator["apps"].add(record.get("app", "Unknown App"))
+            accumulator["raw_messages"].add(message)
+            stacktrace = record.get("span.events.exception.stack_trace", "No Exception Stacktrace") or ""
+            accumulator["stacktraces"][stacktrace] = accumulator["stacktraces"].get(stacktrace, 0) + count
+            accumulator["counts"][column] = accumulator["counts"].get(column, 0) + count
+    return partial
+
+
+def aggregate_backfill(day_files, start_date, period_days=BACKFILL_PERIOD_DAYS, max_workers=BACKFILL_WORKERS):
+    """
+    用进程池并行聚合多个环境、多天的结果文件
+
+    结果文件按轮询分成 进程数 × BACKFILL_SHARDS_PER_WORKER 个分片，每个分片在子进程中聚合为部分结果，
+    父进程按完成顺序合并，最后为未命中规则的消息统一挖掘模板。
+
+    Args:
+        day_files: 列表，元素为 (环境, 日期 YYYY-MM-DD, 结果文件名)
+        start_date: 回填的第一天，统计周期从这一天开始划分
+
+    Returns:
+        dict: {分类: 回填累加器}
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    max_workers = max_workers or os.cpu_count() or 1
+    # 大的文件先分配，各分片的数据量更均衡
+    day_files = sorted(day_files, key=lambda item: os.path.getsize(item[2]), reverse=True)
+    shard_count = max(1, min(len(day_files), max_workers * BACKFILL_SHARDS_PER_WORKER))
+    shards = [day_files[i::shard_count] for i in range(shard_count)]
+    logging.info(f"回填：{len(day_files)} 个结果文件分为 {shard_count} 个分片，使用 {max_workers} 个进程聚合")
+
+    merged = {"categories": {}, "messages": {}}
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(aggregate_backfill_shard, shard, start_date, period_days) for shard in shards]
+        for future in as_completed(futures):
+            merge_backfill_partials(merged, future.result())
+
+    # 未命中规则的消息与已分类的结果合并
+    result = merged["categories"]
+    categories = categorize_messages(merged["messages"].keys())
+    for message, accumulator in merged["messages"].items():
+        category = categories[message]
+        existing = result.get(category)
+        if existing is None:
+            result[category] = accumulator
+        else:
+            merge_backfill_accumulator(existing, accumulator)
+    logging.info(f"回填：分类后有 {len(result)} 种异常消息类型")
+    return result
+
+
+def write_backfill_report(result, output_dir, environments):
+    """
+    写出回填的趋势报表：每个分类一行，每个 (环境, 统计周期) 一列
+
+    Returns:
+        list: 写出的文件名列表
+    """
+    columns = sorted({column for accumulator in result.values() for column in accumulator["counts"]})
+    if len(environments) == 1:
+        column_names = [period for _, period in columns]
+    else:
+        column_names = [f"{environment} {period}" for environment, period in columns]
+    stacktrace_rows = {}
+
+    def iter_trend_rows():
+        sorted_result = sorted(result.items(), key=lambda item: sum(item[1]["counts"].values()), reverse=True)
+        for category, accumulator in sorted_result:
+            display_message = category.replace(".*", "******").strip()
+            stacktrace_counts = {}
+            add_stacktrace_counts(stacktrace_counts, (
+                (stacktrace_table.intern(stacktrace), count) for stacktrace, count in accumulator["stacktraces"].items()
+            ))
+            stacktrace_groups = collect_stacktrace_groups(stacktrace_rows, display_message, stacktrace_counts)
+            yield [
+                ", ".join(sorted(app if app is not None else "" for app in accumulator["apps"])),
+                display_message,
+                "\n\n".join(sorted(accumulator["raw_messages"])).strip(),
+                format_stacktrace_groups(stacktrace_groups),
+                sum(accumulator["counts"].values()),
+            ] + [accumulator["counts"].get(column, 0) for column in columns]
+
+    return write_report(f"{output_dir}/trend", [
+        ("trend", ["app", "exception message(exp)", "raw messages", "exception stacktrace", "total"] + column_names,
+         iter_trend_rows()),
+        ("stacktraces", ["fingerprint", "quantity", "exception messages(exp)", "exception stacktrace"],
+         iter_stacktrace_rows(stacktrace_rows)),
+    ])
+
+
+def backfill(start_date, end_date, environments=(DEFAULT_ENVIRONMENT,), period_days=BACKFILL_PERIOD_DAYS,
+             max_workers=BACKFILL_WORKERS):
+    """
+    回填模式：获取多个环境在 [start_date, end_date] 内每一天的数据，并行聚合后写出趋势报表
+
+    Args:
+        start_date: 第一天，datetime 对象
+        end_date: 最后一天（包含），datetime 对象
+        environments: DYNATRACE_ENVIRONMENTS 中的环境名
+    """
+    output_dir = f"{BACKFILL_OUTPUT_DIR}/{start_date.strftime('%Y%m%d')}_{end_date.strftime('%Y%m%d')}"
+    dates = [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+    logging.info(f"回填 {start_date.strftime('%Y-%m-%d')} ~ {end_date.strftime('%Y-%m-%d')} 共 {len(dates)} 天，"
+                 f"环境：{', '.join(environments)}")
+
+    query = read_query()
+    day_files = []
+    with run_metrics.stage("fetch"):
+        for environment in environments:
+            files = fetch_backfill_days(environment, query, dates, f"{output_dir}/{environment}")
+            day_files.extend((environment, date_str, filename) for date_str, filename in files.items())
+    run_metrics.count("backfill.day_files", len(day_files))
+
+    with run_metrics.stage("aggregate"):
+        result = aggregate_backfill(day_files, start_date, period_days, max_workers)
+    with run_metrics.stage("report"):
+        filenames = write_backfill_report(result, output_dir, environments)
+    logging.info(f"回填完成，结果已保存到 {', '.join(filenames)}")
+    return output_dir
+
+
+class HotStore:
+    """
+    常驻模式的内存聚合存储
+
+    已结束的窗口每天保存一份聚合快照（结构与 build_day_snapshot 相同）；进行中的窗口按时间片分别保存快照，
+    读取时合并为当天的临时快照。每次更新后 version 加一，用于判断计算好的汇总是否过期。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # {date_str: {"snapshot": 快照, "complete": 是否为窗口结束 DAY_CACHE_SETTLE_HOURS 之后获取的数据}}
+        self.days = {}
+        # {date_str: {时间片开始时间: 快照}}
+        self.slices = {}
+        self.version = 0
+
+    def put_day(self, date_str, snapshot, complete):
+        with self.lock:
+            self.days[date_str] = {"snapshot": snapshot, "complete": complete}
+            # 有了整天的数据后不再需要时间片
+            self.slices.pop(date_str, None)
+            self.version += 1
+
+    def put_slice(self, date_str, slice_start, snapshot):
+        with self.lock:
+            self.slices.setdefault(date_str, {})[slice_start] = snapshot
+            self.version += 1
+
+    def has_slice(self, date_str, slice_start):
+        with self.lock:
+            return slice_start in self.slices.get(date_str, {})
+
+    def day_status(self, date_str):
+        """
+        Returns:
+            str: "complete"（完整的整天数据）、"provisional"（未完整的整天数据）、
+                 "partial"（只有部分时间片）或 None（没有数据）
+        """
+        with self.lock:
+            day = self.days.get(date_str)
+            if day is not None:
+                return "complete" if day["complete"] else "provisional"
+            return "partial" if self.slices.get(date_str) else None
+
+    def describe(self, date_strs):
+        """每天的数据状态和已获取的时间片数，用于状态接口。"""
+        with self.lock:
+            slice_counts = {date_str: len(self.slices.get(date_str, {})) for date_str in date_strs}
+        return {date_str: {"status": self.day_status(date_str) or "missing", "slices": slice_counts[date_str]}
+                for date_str in date_strs}
+
+    def retain(self, date_strs):
+        """只保留 date_strs 中的日期，返回被移除的日期。"""
+        with self.lock:
+            stale = sorted((set(self.days) | set(self.slices)) - set(date_strs))
+            for date_str in stale:
+                self.days.pop(date_str, None)
+                self.slices.pop(date_str, None)
+            if stale:
+                self.version += 1
+        return stale
+
+    def clear(self):
+        with self.lock:
+            self.days.clear()
+            self.slices.clear()
+            self.version += 1
+
+    def known_messages(self):
+        with self.lock:
+            snapshots = [day["snapshot"] for day in self.days.values()]
+            snapshots += [snapshot for slices in self.slices.values() for snapshot in slices.values()]
+        return {message for snapshot in snapshots for message in snapshot["messages"]}
+
+    def day_snapshot(self, date_str):
+        """一天的快照；只有时间片时合并已获取的时间片，没有数据时返回空快照。"""
+        with self.lock:
+            day = self.days.get(date_str)
+            slices = list(self.slices.get(date_str, {}).values())
+        if day is not None:
+            return day["snapshot"]
+        state = {"version": SNAPSHOT_VERSION, "messages": {}, "stacktraces": {}}
+        for snapshot in slices:
+            combine_snapshot(state, snapshot, 1)
+        return state
+
+    def window_state(self, date_strs):
+        """多天组成的窗口的聚合状态，结构与 SlidingWindowEngine.window 的返回值相同。"""
+        state = {"version": SNAPSHOT_VERSION, "messages": {}, "stacktraces": {}}
+        for date_str in date_strs:
+            combine_snapshot(state, self.day_snapshot(date_str), 1)
+        return state
+
+
+def dataset_dates(last_date):
+    """以 last_date 为基准往前推7天的数据集包含的日期，与 get_unique_date_ranges 的顺序相同。"""
+    return [(last_date - timedelta(days=7 - i)).strftime('%Y-%m-%d') for i in range(7)]
+
+
+class ReportDaemon:
+    """
+    常驻模式：窗口一结束就获取数据并更新内存中的聚合，随时返回当前的汇总或生成报表
+
+    每次 tick：
+    - 进行中的 10:00→10:00 窗口按 DAEMON_SLICE_HOURS 切片，每个时间片结束 DAEMON_FETCH_DELAY_MINUTES 分钟后获取；
+    - 已结束但还没有任何数据的窗口整天获取，优先使用本地按天缓存；
+    - 窗口结束 DAY_CACHE_SETTLE_HOURS 小时后再整天获取一次，替换时间片和未完整的数据，
+      之后的计数与单次运行完全相同；
+    - 数据变化后立即重新计算汇总，HTTP 请求只读取计算好的结果。
+    """
+
+    def __init__(self, store=None):
+        self.store = store or HotStore()
+        self.query = None
+        self.context = None
+        self.summary = None
+        # 查询失败的窗口在此时间之前不再重试，{(开始时间, 结束时间): datetime}
+        self.retry_at = {}
+        self.refresh_lock = threading.Lock()
+        self.render_lock = threading.Lock()
+
+    def tick(self, now=None):
+        """检查并获取所有已结束但还没有获取的窗口，然后更新汇总。"""
+        now = now or datetime.now()
+        context = RunContext(now)
+        # 常驻进程中 query_latencies 只保留本次 tick 的查询耗时，不随运行时间无限增长
+        query_latencies.clear()
+        query = read_query()
+        if query != self.query:
+            if self.query is not None:
+                logging.info("查询语句已修改，清空内存中的聚合")
+                self.store.clear()
+            self.query = query
+
+        dates = self.needed_dates(context, now)
+        stale = self.store.retain(dates)
+        if stale:
+            logging.info(f"移除不再需要的日期：{', '.join(stale)}")
+            # 旧的堆栈跟踪不再被引用，清空驻留表，避免常驻进程的内存持续增长；
+            # 驻留表只在 refresh 中使用，持有 refresh_lock 时清空，不会与正在计算的汇总交错
+            with self.refresh_lock:
+                stacktrace_table.clear()
+
+        full_days, slices = self.plan(dates, now)
+        if full_days or slices:
+            with run_metrics.stage("daemon.fetch"):
+                self.fetch(query, full_days, slices, now)
+        self.context = context
+        return self.refresh()
+
+    @staticmethod
+    def needed_dates(context, now):
+        """
+        当前报表需要的日期，加上进行中的窗口（明天会成为今天数据集的最新1天）
+
+        Returns:
+            dict: {date_str: date_obj}
+        """
+        dates = {date_str: info['date'] for date_str, info in get_unique_date_ranges(context).items()}
+        for date_obj in (now - timedelta(days=1), now):
+            start_time_str, end_time_str = day_window(date_obj)
+            if datetime.fromisoformat(start_time_str) <= now < datetime.fromisoformat(end_time_str):
+                dates[date_obj.strftime('%Y-%m-%d')] = date_obj
+        return dates
+
+    def plan(self, dates, now):
+        """
+        Returns:
+            tuple: (需要整天获取的 [(date_str, 开始时间, 结束时间)], 需要获取的时间片 [(date_str, 开始时间, 结束时间)])
+        """
+        delay = timedelta(minutes=DAEMON_FETCH_DELAY_MINUTES)
+        settle = timedelta(hours=DAY_CACHE_SETTLE_HOURS)
+        full_days = []
+        slices = []
+        for date_str, date_obj in sorted(dates.items()):
+            status = self.store.day_status(date_str)
+            if status == "complete":
+                continue
+            start_time_str, end_time_str = day_window(date_obj)
+            end_time = datetime.fromisoformat(end_time_str)
+            if now >= end_time + settle or (status is None and now >= end_time + delay):
+                full_days.append((date_str, start_time_str, end_time_str))
+            elif status != "provisional":
+                for slice_start, slice_end in split_window(start_time_str, end_time_str, 24 // DAEMON_SLICE_HOURS):
+                    if now >= datetime.fromisoformat(slice_end) + delay and not self.store.has_slice(date_str, slice_start):
+                        slices.append((date_str, slice_start, slice_end))
+        full_days = [window for window in full_days if now >= self.retry_at.get(window[1:], now)]
+        slices = [window for window in slices if now >= self.retry_at.get(window[1:], now)]
+        return full_days, slices
+
+    def fetch(self, query, full_days, slices, now):
+        day_cache = DayCache()
+        cache_query = make_cache_query(query)
+        settle = timedelta(hours=DAY_CACHE_SETTLE_HOURS)
+        pending_windows = []
+        for date_str, start_time_str, end_time_str in full_days:
+            # 窗口已经稳定时不使用未完整的缓存，重新获取完整的数据
+            settled = now >= datetime.fromisoformat(end_time_str) + settle
+            if not settled or day_cache.is_complete(cache_query, start_time_str, end_time_str):
+                cached_filename = day_cache.get_filename(cache_query, start_time_str, end_time_str)
+                if cached_filename is not None:
+                    self.load_day(date_str, cached_filename,
+                                  day_cache.is_complete(cache_query, start_time_str, end_time_str))
+                    continue
+            pending_windows.append((date_str, start_time_str, end_time_str))
+        if not pending_windows and not slices:
+            return
+
+        # 每次获取前重新读取 cookie，cookie 过期后更新文件即可，不需要重启
+        cookie, csrftoken = read_credentials()
+        known_messages = self.store.known_messages() if FETCH_MODE == "two_phase" else frozenset()
+        # 时间片的标签为开始时间精确到小时，例如 2025-10-13T10
+        slice_windows = {slice_start[:13]: (date_str, slice_start, slice_end)
+                         for date_str, slice_start, slice_end in slices}
+        logging.info(f"常驻模式：整天获取 {len(pending_windows)} 天，获取 {len(slice_windows)} 个时间片")
+        with DynatraceClient(cookie, csrftoken) as client:
+            fetched_files = fetch_windows(client, query, pending_windows, day_cache.staging_dir,
+                                          known_messages=known_messages,
+                                          slice_plan=SlicePlan() if ADAPTIVE_WINDOWS else None)
+            # 时间片不使用 SlicePlan，计划只按整天记录粒度
+            fetched_slices = fetch_windows(client, query, [(label, *window[1:]) for label, window in
+                                                           slice_windows.items()],
+                                           day_cache.staging_dir, known_messages=known_messages)
+
+        retry_at = now + timedelta(minutes=DAEMON_RETRY_MINUTES)
+        for date_str, start_time_str, end_time_str in pending_windows:
+            temp_filename = fetched_files.get(date_str)
+            if temp_filename:
+                filename = day_cache.put_file(cache_query, start_time_str, end_time_str, temp_filename)
+                self.load_day(date_str, filename, day_cache.is_complete(cache_query, start_time_str, end_time_str))
+                self.retry_at.pop((start_time_str, end_time_str), None)
+            else:
+                logging.error(f"{date_str} 的数据获取失败，{DAEMON_RETRY_MINUTES} 分钟后重试")
+                self.retry_at[(start_time_str, end_time_str)] = retry_at
+        for label, (date_str, slice_start, slice_end) in slice_windows.items():
+            temp_filename = fetched_slices.get(label)
+            if temp_filename:
+                with run_metrics.stage("daemon.snapshot"):
+                    snapshot = build_day_snapshot(iter_day_records(temp_filename))
+                os.remove(temp_filename)
+                self.store.put_slice(date_str, slice_start, snapshot)
+                self.retry_at.pop((slice_start, slice_end), None)
+                run_metrics.count("daemon.slices")
+            else:
+                logging.error(f"时间片 {slice_start} ~ {slice_end} 获取失败，{DAEMON_RETRY_MINUTES} 分钟后重试")
+                self.retry_at[(slice_start, slice_end)] = retry_at
+
+    def load_day(self, date_str, filename, complete):
+        with run_metrics.stage("daemon.snapshot"):
+            snapshot = build_day_snapshot(iter_day_records(filename))
+        self.store.put_day(date_str, snapshot, complete)
+        run_metrics.count("daemon.days")
+        logging.info(f"{date_str} 的{'完整' if complete else '未完整'}数据已载入内存")
+
+    def refresh(self):
+        """
+        内存中的数据或日期变化后重新计算汇总，否则直接返回上次的结果
+
+        Returns:
+            dict: 包括 context、version、generated_at、days、summary_rows 和 stacktrace_rows，没有运行过 tick 时为 None
+        """
+        with self.refresh_lock:
+            context = self.context
+            if context is None:
+                return None
+            version = self.store.version
+            summary = self.summary
+            if (summary is not None and summary["version"] == version
+                    and summary["context"].today_str == context.today_str):
+                return summary
+
+            current_dates = dataset_dates(context.today)
+            previous_dates = dataset_dates(context.previous_workday)
+            with run_metrics.stage("daemon.refresh"):
+                with run_metrics.stage("aggregate"):
+                    result = aggregate_window_states(
+                        [(self.store.window_state(current_dates), "current_7_days_count"),
+                         (self.store.window_state(previous_dates), "previous_workday_7_days_count")],
+                        [(self.store.day_snapshot(current_dates[-1]), "last_1_day_count"),
+                         (self.store.day_snapshot(previous_dates[-1]), "pre_last_1_day_count")],
+                    )
+                sorted_result = categorize_result(result)
+                stacktrace_rows = {}
+                summary_rows = list(iter_summary_rows(sorted_result, stacktrace_rows))
+                self.summary = {
+                    "context": context,
+                    "version": version,
+                    "generated_at": datetime.now(),
+                    "days": self.store.describe(sorted(set(current_dates) | set(previous_dates))),
+                    "summary_rows": summary_rows,
+                    "stacktrace_rows": list(iter_stacktrace_rows(stacktrace_rows)),
+                }
+            return self.summary
+
+    def render(self, formats=None):
+        """把当前汇总写成报表文件，返回文件名列表。"""
+        summary = self.refresh()
+        if summary is None:
+            return []
+        context = summary["context"].prepare()
+        with self.render_lock, run_metrics.stage("report"):
+            filenames = write_report(f"{context.output_dir}/summary", [
+                ("summary", SUMMARY_COLUMNS, iter(summary["summary_rows"])),
+                ("stacktraces", STACKTRACE_COLUMNS, iter(summary["stacktrace_rows"])),
+            ], formats)
+        logging.info(f"报表已保存到 {', '.join(filenames)}")
+        return filenames
+
+    def status(self):
+        summary = self.summary
+        if summary is None:
+            return {"ready": False, "metrics": run_metrics.to_dict()}
+        return {
+            "ready": True,
+            "today": summary["context"].today.strftime('%Y-%m-%d'),
+            "previous_workday": summary["context"].previous_workday.strftime('%Y-%m-%d'),
+            "generated_at": summary["generated_at"].isoformat(),
+            "categories": len(summary["summary_rows"]),
+            "days": summary["days"],
+            "metrics": run_metrics.to_dict(),
+        }
+
+
+def make_daemon_server(daemon, host=DAEMON_HOST, port=DAEMON_PORT):
+    """
+    创建常驻模式的本地 HTTP 服务
+
+    GET /summary：当前汇总，每行是 SUMMARY_COLUMNS 对应的字典
+    GET /report?format=xlsx,csv：按当前汇总生成报表文件，返回文件名，默认使用 REPORT_FORMATS
+    GET /status：每天的数据状态和运行指标
+    """
+    # http.server 只有常驻模式使用，在这里导入以加快启动
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import parse_qs, urlparse
+
+    class DaemonHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            logging.debug("HTTP %s", format % args)
+
+        def send_json(self, status, payload):
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == "/status":
+                self.send_json(200, daemon.status())
+                return
+            if url.path not in ("/summary", "/report"):
+                self.send_json(404, {"error": "Not Found"})
+                return
+            summary = daemon.refresh()
+            if summary is None:
+                self.send_json(503, {"error": "尚未完成第一次获取"})
+                return
+
+            if url.path == "/summary":
+                self.send_json(200, {
+                    "today": summary["context"].today.strftime('%Y-%m-%d'),
+                    "previous_workday": summary["context"].previous_workday.strftime('%Y-%m-%d'),
+                    "generated_at": summary["generated_at"].isoformat(),
+                    "days": summary["days"],
+                    "rows": [dict(zip(SUMMARY_COLUMNS, row)) for row in summary["summary_rows"]],
+                })
+                return
+
+            formats = [value for values in parse_qs(url.query).get("format", []) for value in values.split(",") if value]
+            unknown = [file_format for file_format in formats if file_format not in REPORT_WRITERS]
+            if unknown:
+                self.send_json(400, {"error": f"不支持的报表格式：{', '.join(unknown)}"})
+                return
+            started = time.perf_counter()
+            filenames = daemon.render(formats or None)
+            self.send_json(200, {"files": filenames, "seconds": round(time.perf_counter() - started, 3)})
+
+    return ThreadingHTTPServer((host, port), DaemonHandler)
+
+
+def main(context=None):
+    context = (context or get_run_context()).prepare()
+    # 设置日志记录
+    log_file = setup_logging(context)
+    logging.info(f"日志文件：{log_file}")
+    run_metrics.reset()
+
+    # 从 resources 读取查询、cookie 和 csrftoken
+    query = read_query()
+    cookie, csrftoken = read_credentials()
     logging.info("已读取查询和 cookie。")
 
-    logging.info(f"今天是：{today.strftime('%Y-%m-%d %A')}")
-    logging.info(f"上一个工作日是：{previous_workday.strftime('%Y-%m-%d %A')}")
+    logging.info(f"今天是：{context.today.strftime('%Y-%m-%d %A')}")
+    logging.info(f"上一个工作日是：{context.previous_workday.strftime('%Y-%m-%d %A')}")
 
     # 计算所有需要获取的唯一日期2
-    unique_dates = get_unique_date_ranges()
+    unique_dates = get_unique_date_ranges(context)
     total_requests = len(unique_dates)
     duplicate_saved = 14 - total_requests  # 总共14个请求减去实际需要的请求数
 
     logging.info(f"优化后需要 {total_requests} 个请求（节省了 {duplicate_saved} 个重复请求）")
 
-    # 存储请求结果的映射
-    date_to_data = {}
+    # 每个日期对应的唯一一份结果文件（位于本地缓存中）
+    day_files = {}
+    day_cache = DayCache()
+    cache_query = make_cache_query(query)
+    cache_hits = 0
+    pending_windows = []
 
     # 按日期排序，统一获取数据
     sorted_dates = sorted(unique_dates.items())
@@ -449,53 +3437,213 @@ def main():
         date_obj = date_info['date']
         needed_for = date_info['needed_for']
 
-        # 设置开始、结束时间的小时数为 10:00:00
-        start_time_str = date_obj.strftime("%Y-%m-%dT10:00:00.000")
-        end_time_str = (date_obj + timedelta(days=1)).strftime("%Y-%m-%dT10:00:00.000")
+        start_time_str, end_time_str = day_window(date_obj)
 
-        logging.info(f"正在获取 {date_str} 的数据，需要用于：{needed_for}")
+        cached_filename = day_cache.get_filename(cache_query, start_time_str, end_time_str)
+        if cached_filename is not None:
+            day_files[date_str] = cached_filename
+            cache_hits += 1
+            logging.info(f"{date_str} 的数据命中本地缓存，需要用于：{needed_for}")
+            continue
 
-        # 使用临时文件名，稍后会复制到相应位置
-        temp_output_dir = "temp_data"
-        os.makedirs(temp_output_dir, exist_ok=True)
+        logging.info(f"需要获取 {date_str} 的数据，需要用于：{needed_for}")
+        pending_windows.append((date_str, start_time_str, end_time_str))
 
-        temp_filename = make_request(query, cookie, csrftoken, start_time_str, end_time_str,
-                                     date_str.replace('-', ''), temp_output_dir)
+    # 并发获取所有未命中缓存的日期，结果先写到缓存的暂存目录，成功后移入缓存
+    known_messages = collect_known_messages(day_files.values()) if FETCH_MODE == "two_phase" else frozenset()
+    with run_metrics.stage("fetch"), DynatraceClient(cookie, csrftoken) as client:
+        fetched_files = fetch_windows(client, query, pending_windows, day_cache.staging_dir,
+                                      known_messages=known_messages,
+                                      slice_plan=SlicePlan() if ADAPTIVE_WINDOWS else None)
 
+    for date_str, start_time_str, end_time_str in pending_windows:
+        temp_filename = fetched_files.get(date_str)
         if temp_filename:
-            # 读取数据
-            with open(temp_filename, 'r') as f:
-                data = json.load(f)
-            date_to_data[date_str] = data
+            day_files[date_str] = day_cache.put_file(cache_query, start_time_str, end_time_str, temp_filename)
             logging.info(f"{date_str} 的数据获取成功")
         else:
             logging.error(f"{date_str} 的数据获取失败")
-            date_to_data[date_str] = []
 
-    # 将数据复制到相应的目录和文件名
+    logging.info(f"本地缓存命中 {cache_hits} 天，实际发送 {total_requests - cache_hits} 个 DQL 请求")
+    run_metrics.count("day_cache.hits", cache_hits)
+    run_metrics.count("day_cache.misses", total_requests - cache_hits)
+
+    # 将每个日期的唯一一份数据链接到相应数据集的 dql_result_for_day_{n}，并记录到清单中
+    manifests = {context.output_dir: {}, context.previous_workday_output_dir: {}}
     for date_str, date_info in unique_dates.items():
-        data = date_to_data.get(date_str, [])
+        source = day_files.get(date_str)
 
         for dataset_type, day_num in date_info['needed_for']:
             if dataset_type == 'current':
-                output_dir = OUTPUT_DIR
-                logging.info(f"保存 {date_str} 数据到今天数据集第 {day_num} 天")
+                output_dir = context.output_dir
+                logging.info(f"关联 {date_str} 数据到今天数据集第 {day_num} 天")
             else:  # previous
-                output_dir = PREVIOUS_WORKDAY_OUTPUT_DIR
-                logging.info(f"保存 {date_str} 数据到上一个工作日数据集第 {day_num} 天")
+                output_dir = context.previous_workday_output_dir
+                logging.info(f"关联 {date_str} 数据到上一个工作日数据集第 {day_num} 天")
+
+            target = day_filename(output_dir, day_num)
+            if source is None:
+                write_day_records([], target)
+                method = "empty"
+            else:
+                method = link_day_file(source, target)
+            manifests[output_dir][day_num] = {"date": date_str, "source": source, "link": method}
+
+    for output_dir, days in manifests.items():
+        write_dataset_manifest(output_dir, days)
+
+    handle_data(context)
+    run_metrics.write(context.output_dir)
+
+
+def run_profiled(function, output_dir):
+    """
+    在 cProfile 下运行 function，统计结果保存为 output_dir/profile.pstats，并在日志中输出累计耗时最多的函数
 
-            output_filename = f'{output_dir}/dql_result_for_day_{day_num}.json'
-            with open(output_filename, 'w') as f:
-                json.dump(data, f, indent=4)
+    cProfile 只统计调用线程，并发查询线程中的耗时体现在 run_metrics 的 http.* 和 dql.* 阶段中。
+    """
+    import cProfile
+    import pstats
 
-    # 清理临时目录
-    import shutil
-    if os.path.exists("temp_data"):
-        shutil.rmtree("temp_data")
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function)
+    finally:
+        os.makedirs(output_dir, exist_ok=True)
+        profile_filename = f"{output_dir}/profile.pstats"
+        profiler.dump_stats(profile_filename)
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+        logging.info(f"性能分析结果已保存到 {profile_filename}，累计耗时最多的函数：\n{stream.getvalue()}")
+
+
+def find_run_metrics(output_root="output"):
+    """按修改时间从旧到新返回 output_root 下各天日常运行的指标文件，不包括回填。"""
+    filenames = []
+    for name in os.listdir(output_root) if os.path.isdir(output_root) else []:
+        filename = os.path.join(output_root, name, RUN_METRICS_FILE)
+        if name.isdigit() and os.path.exists(filename):
+            filenames.append(filename)
+    return sorted(filenames, key=os.path.getmtime)
+
+
+def compare_run_metrics(baseline_filename, current_filename, ratio=METRICS_REGRESSION_RATIO,
+                        min_seconds=METRICS_REGRESSION_MIN_SECONDS):
+    """
+    比较两次运行的阶段耗时和峰值内存，输出对比表
 
-    handle_data()
+    Returns:
+        list: 退化的阶段名；耗时超过基线 ratio 倍且多出 min_seconds 秒以上视为退化
+    """
+    with open(baseline_filename, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    with open(current_filename, 'r', encoding='utf-8') as f:
+        current = json.load(f)
+
+    rows = [("wall", baseline["wall_seconds"], current["wall_seconds"])]
+    for name in sorted(set(baseline["stages"]) | set(current["stages"])):
+        rows.append((name, baseline["stages"].get(name, {}).get("seconds", 0.0),
+                     current["stages"].get(name, {}).get("seconds", 0.0)))
+
+    regressions = []
+    lines = [f"基线：{baseline_filename}", f"当前：{current_filename}",
+             f"{'stage':<28} {'baseline s':>12} {'current s':>12} {'ratio':>8}"]
+    for name, before, after in rows:
+        regressed = after - before > min_seconds and after > before * ratio
+        if regressed:
+            regressions.append(name)
+        ratio_text = f"{after / before:.2f}" if before else "-"
+        lines.append(f"{name:<28} {before:>12.3f} {after:>12.3f} {ratio_text:>8}{'  <- 退化' if regressed else ''}")
+    lines.append(f"{'peak memory MB':<28} {baseline.get('peak_memory_mb') or 0:>12.0f} "
+                 f"{current.get('peak_memory_mb') or 0:>12.0f}")
+    print("\n".join(lines))
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="获取 Dynatrace 异常记录并生成生产例会报表")
+    parser.add_argument("--profile", action="store_true", help="在 cProfile 下运行，结果保存为输出目录下的 profile.pstats")
+    parser.add_argument("--date", type=lambda value: datetime.strptime(value, '%Y-%m-%d'),
+                        help="把指定日期（YYYY-MM-DD）当作今天生成报表，默认为今天")
+    subparsers = parser.add_subparsers(dest="command")
+
+    backfill_parser = subparsers.add_parser("backfill", help="回填多天、多个环境的数据并生成趋势报表")
+    backfill_parser.add_argument("--start", required=True, type=lambda value: datetime.strptime(value, '%Y-%m-%d'),
+                                 help="第一天，格式 YYYY-MM-DD")
+    backfill_parser.add_argument("--end", required=True, type=lambda value: datetime.strptime(value, '%Y-%m-%d'),
+                                 help="最后一天（包含），格式 YYYY-MM-DD")
+    backfill_parser.add_argument("--env", action="append", choices=sorted(DYNATRACE_ENVIRONMENTS), dest="environments",
+                                 help=f"环境名，可以指定多次，默认为 {DEFAULT_ENVIRONMENT}")
+    backfill_parser.add_argument("--period-days", type=int, default=BACKFILL_PERIOD_DAYS, help="每个统计周期的天数")
+    backfill_parser.add_argument("--workers", type=int, default=BACKFILL_WORKERS, help="聚合使用的进程数，默认为 CPU 核心数")
+
+    daemon_parser = subparsers.add_parser("daemon", help="常驻运行：窗口结束后立即获取数据，通过本地 HTTP 服务提供汇总和报表")
+    daemon_parser.add_argument("--host", default=DAEMON_HOST, help="HTTP 服务监听的地址")
+    daemon_parser.add_argument("--port", type=int, default=DAEMON_PORT, help="HTTP 服务监听的端口")
+    daemon_parser.add_argument("--check-seconds", type=float, default=DAEMON_CHECK_SECONDS,
+                               help="检查是否有新窗口可以获取的间隔（秒）")
+
+    compare_parser = subparsers.add_parser("compare-metrics", help="比较两次运行的性能指标，发现退化时返回非零退出码")
+    compare_parser.add_argument("--baseline", help="基线的 run_metrics.json，默认为倒数第二次运行")
+    compare_parser.add_argument("--current", help="当前的 run_metrics.json，默认为最近一次运行")
+    return parser.parse_args(argv)
+
+
+def run_backfill(args):
+    setup_logging()
+    run_metrics.reset()
+    output_dir = backfill(args.start, args.end, args.environments or [DEFAULT_ENVIRONMENT], args.period_days,
+                          args.workers)
+    run_metrics.write(output_dir)
+
+
+def run_daemon(args):
+    setup_logging()
+    run_metrics.reset()
+    daemon = ReportDaemon()
+    server = make_daemon_server(daemon, args.host, args.port)
+    threading.Thread(target=server.serve_forever, name="daemon-http", daemon=True).start()
+    logging.info(f"常驻模式已启动，汇总：http://{args.host}:{server.server_port}/summary，"
+                 f"报表：http://{args.host}:{server.server_port}/report")
+    try:
+        while True:
+            try:
+                daemon.tick()
+            except Exception:
+                logging.error(f"常驻模式获取数据时出现未处理的异常：{traceback.format_exc()}")
+            time.sleep(args.check_seconds)
+    except KeyboardInterrupt:
+        logging.info("常驻模式已停止")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def run_compare_metrics(args):
+    history = find_run_metrics()
+    current = args.current or (history[-1] if history else None)
+    baseline = args.baseline or next((filename for filename in reversed(history) if filename != current), None)
+    if current is None or baseline is None:
+        print("需要至少两次运行的 run_metrics.json，或通过 --baseline 和 --current 指定")
+        return 2
+    regressions = compare_run_metrics(baseline, current)
+    return 1 if regressions else 0
 
 
 if __name__ == "__main__":
-    main()
+    args = parse_args()
+    if args.command == "compare-metrics":
+        sys.exit(run_compare_metrics(args))
+    if args.date is not None:
+        set_run_context(RunContext(args.date))
+    if args.command == "backfill":
+        command, output_dir = functools.partial(run_backfill, args), BACKFILL_OUTPUT_DIR
+    elif args.command == "daemon":
+        command, output_dir = functools.partial(run_daemon, args), get_run_context().output_dir
+    else:
+        command, output_dir = main, get_run_context().output_dir
+    if args.profile:
+        run_profiled(command, output_dir)
+    else:
+        command()
     # handle_data()
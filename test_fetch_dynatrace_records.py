@@ -0,0 +1,232 @@
+"""
+fetch_dynatrace_records 的回归测试
+
+运行：python -m pytest -q
+
+所有测试在 pytest 的临时目录中运行，不读写当前目录的 cache/ 和 output/；
+查询相关的测试使用 benchmark.py 中的 Dynatrace 替身服务器（MockDynatraceServer）。
+"""
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import benchmark
+import fetch_dynatrace_records as fdr
+
+QUERY = """fetch spans
+| summarize {count(),min(start_time) }, by:{app, span.events.exception.message, span.events.exception.stack_trace}"""
+
+
+@pytest.fixture(autouse=True)
+def work_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(fdr, "backoff_delay", lambda attempt: 0.0)
+    return tmp_path
+
+
+@pytest.fixture
+def mock_server():
+    servers = []
+
+    def start(**kwargs):
+        server = benchmark.MockDynatraceServer(latency=kwargs.pop("latency", 0.01), **kwargs).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def comparable(result):
+    """把 {message: 累加器} 转为不依赖堆栈跟踪编号的结构，便于比较两种聚合方式。"""
+    return {
+        message: (
+            {field: accumulator[field] for field in fdr.COUNTER_FIELDS},
+            accumulator["apps"],
+            {fdr.stacktrace_table.text(stacktrace_id): count
+             for stacktrace_id, count in accumulator["stacktraces"].items()},
+        )
+        for message, accumulator in result.items()
+    }
+
+
+def sort_records(records):
+    return sorted(records, key=lambda record: json.dumps(record, sort_keys=True))
+
+
+def write_dataset(output_dir, day_files):
+    """用硬链接把每天的结果文件放进数据集目录，与主脚本复用缓存文件的方式相同。"""
+    os.makedirs(output_dir, exist_ok=True)
+    for day_num, filename in enumerate(day_files, start=1):
+        os.link(filename, fdr.day_filename(output_dir, day_num, "columnar"))
+
+
+@pytest.fixture
+def day_files(work_dir):
+    os.makedirs("days")
+    files = []
+    for day in range(9):
+        records = benchmark.generate_records(400, distinct_messages=60, seed=day)
+        filename = f"days/day_{day}.dcol"
+        fdr.write_columnar_records(records, filename)
+        files.append(filename)
+    return files
+
+
+def test_incremental_matches_streaming_cold_warm_and_sliding(day_files):
+    write_dataset("a/current", day_files[1:8])
+    write_dataset("a/previous", day_files[0:7])
+    expected = comparable(fdr.aggregate_output_dirs("a/current", "a/previous"))
+
+    # 冷启动：没有任何快照和窗口状态
+    assert comparable(fdr.aggregate_incremental("a/current", "a/previous")) == expected
+    # 热启动：新的引擎实例从磁盘读取快照和窗口状态
+    assert comparable(fdr.aggregate_incremental("a/current", "a/previous", fdr.SlidingWindowEngine())) == expected
+
+    # 滑动一天：复用已保存的窗口，加上新增的一天、减去过期的一天
+    write_dataset("b/current", day_files[2:9])
+    write_dataset("b/previous", day_files[1:8])
+    expected = comparable(fdr.aggregate_output_dirs("b/current", "b/previous"))
+    assert comparable(fdr.aggregate_incremental("b/current", "b/previous")) == expected
+
+
+def test_columnar_round_trip(work_dir):
+    records = benchmark.generate_records(500, distinct_messages=40, seed=1)
+    records += [
+        {"app": None, "span.events.exception.message": "含中文的消息", "count()": 0},
+        {"span.events.exception.message": "只有部分列", "extra": [1, {"nested": True}]},
+        {},
+    ]
+    fdr.write_columnar_records(records, "records.dcol")
+    assert list(fdr.iter_columnar_records("records.dcol")) == records
+
+    fdr.write_columnar_records([], "empty.dcol")
+    assert list(fdr.iter_columnar_records("empty.dcol")) == []
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 64, fdr.STREAM_CHUNK_SIZE])
+def test_iter_json_records_small_chunks(work_dir, chunk_size):
+    records = benchmark.generate_records(50, distinct_messages=10, seed=2)
+    records += [
+        {"span.events.exception.message": "括号 ] 和 } 以及 \", 逗号", "count()": 3},
+        {"span.events.exception.message": "转义 \\\" \\n  ", "nested": {"a": [1, 2, {"b": "]"}]}},
+    ]
+    with open("records.json", 'w', encoding='utf-8') as f:
+        f.write("  \n[\n")
+        f.write(",\n  ".join(json.dumps(record, ensure_ascii=False) for record in records))
+        f.write("\n]\n")
+    assert list(fdr.iter_json_records("records.json", chunk_size=chunk_size)) == records
+
+    for content in ("[]", " [ ] ", ""):
+        with open("empty.json", 'w', encoding='utf-8') as f:
+            f.write(content)
+        assert list(fdr.iter_json_records("empty.json", chunk_size=chunk_size)) == []
+
+
+def test_merge_partial_records():
+    key = {"app": "a", "span.events.exception.message": "m", "span.events.exception.stack_trace": "s"}
+    merged = fdr.merge_partial_records([
+        [dict(key, **{"count()": 2, "min(start_time)": "2025-01-01T12:00:00Z"}),
+         {"app": "b", "span.events.exception.message": "m", "span.events.exception.stack_trace": "s", "count()": 1}],
+        [dict(key, **{"count()": "3", "min(start_time)": "2025-01-01T11:00:00Z"})],
+        [dict(key, **{"count()": 4, "min(start_time)": None})],
+    ])
+    assert sort_records(merged) == sort_records([
+        dict(key, **{"count()": 9, "min(start_time)": "2025-01-01T11:00:00Z"}),
+        {"app": "b", "span.events.exception.message": "m", "span.events.exception.stack_trace": "s", "count()": 1},
+    ])
+
+
+def test_fetch_records_adaptive_splits_truncated_windows(mock_server):
+    # 整天 400 条、半天 200 条都超过 150 条的上限，拆成 4 个时间片后不再截断
+    server = mock_server(records_per_day=400, max_records=150)
+    start, end = fdr.day_window(fdr.datetime(2025, 1, 1))
+    with fdr.DynatraceClient("cookie", "csrftoken", base_url=server.base_url) as client:
+        records, depth = fdr.fetch_records_adaptive(client, QUERY, start, end, "20250101")
+
+    assert depth == 2
+    assert server.stats["execute"] == 1 + 2 + 4
+    slices = [window for half in fdr.split_window(start, end) for window in fdr.split_window(*half)]
+    expected = fdr.merge_partial_records(
+        server.result({
+            "query": QUERY, "defaultTimeframeStart": slice_start, "defaultTimeframeEnd": slice_end,
+        })["records"]
+        for slice_start, slice_end in slices
+    )
+    assert sort_records(records) == sort_records(expected)
+
+
+def test_fetch_records_adaptive_splits_failed_queries(mock_server, monkeypatch):
+    monkeypatch.setattr(fdr, "WINDOW_MAX_SPLIT_DEPTH", 1)
+    server = mock_server(query_failure_rate=1.0)
+    start, end = fdr.day_window(fdr.datetime(2025, 1, 1))
+    with fdr.DynatraceClient("cookie", "csrftoken", base_url=server.base_url) as client:
+        assert fdr.fetch_records_adaptive(client, QUERY, start, end, "20250101") is None
+    assert server.stats["execute"] == 3
+
+
+def test_rejected_query_is_not_split():
+    executes = []
+
+    class RejectingHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_POST(self):
+            executes.append(self.path)
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            body = b'{"error": {"code": 401, "message": "Unauthorized"}}'
+            self.send_response(401)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RejectingHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        start, end = fdr.day_window(fdr.datetime(2025, 1, 1))
+        base_url = f"http://127.0.0.1:{server.server_address[1]}"
+        with fdr.DynatraceClient("cookie", "csrftoken", base_url=base_url) as client:
+            assert fdr.run_query_with_status(client, QUERY, start, end, "20250101") == (None, "REJECTED")
+            executes.clear()
+            assert fdr.fetch_records_adaptive(client, QUERY, start, end, "20250101") is None
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert len(executes) == 1
+
+
+def put_days(cache_dir, worker, days):
+    """在子进程中向共享的缓存目录写入 days 个条目。"""
+    day_cache = fdr.DayCache(cache_dir)
+    for day in range(days):
+        filename = f"{day_cache.staging_dir}/dql_result_for_day_{day}.dcol"
+        fdr.write_columnar_records([{"worker": worker, "day": day}], filename)
+        start = f"2025-01-{day + 1:02d}T10:00:00.000"
+        day_cache.put_file(f"query {worker}", start, start.replace("T10", "T11"), filename)
+
+
+def test_day_cache_concurrent_writers(work_dir):
+    import multiprocessing
+
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=put_days, args=("cache", worker, 20)) for worker in range(4)]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join()
+        assert process.exitcode == 0
+
+    day_cache = fdr.DayCache("cache")
+    assert len(day_cache.index) == 4 * 20
+    for worker in range(4):
+        for day in range(20):
+            start = f"2025-01-{day + 1:02d}T10:00:00.000"
+            filename = day_cache.get_filename(f"query {worker}", start, start.replace("T10", "T11"))
+            assert list(fdr.iter_columnar_records(filename)) == [{"worker": worker, "day": day}]